@@ -0,0 +1,35 @@
+'''Compares two benchmark result files, printing how each fixture and stage changed
+
+    python -m benchmarks.compare before.json after.json
+'''
+import sys
+import json
+
+def load(path):
+    with open(path) as fd:
+        return {(r['fixture'], r['mode']): r for r in json.load(fd)['results']}
+
+def change(old, new):
+    if not old or new == None:
+        return '      -'
+    return '{:+6.1f}%'.format((new - old) / old * 100)
+
+def main(argv = None):
+    before_path, after_path = argv or sys.argv[1:]
+    before, after = load(before_path), load(after_path)
+
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+
+        print('{} {}: {:.3f}s -> {:.3f}s {}, peak RSS {:.0f} -> {:.0f} MB'.format(
+            key[0], key[1], old['wall'], new['wall'], change(old['wall'], new['wall']),
+            old['peak_rss'] / 2**20, new['peak_rss'] / 2**20))
+
+        for stage in sorted(set(old['stages']) | set(new['stages'])):
+            print('    {:<16} {:>8} -> {:>8} {}'.format(stage,
+                '{:.3f}s'.format(old['stages'][stage]) if stage in old['stages'] else '-',
+                '{:.3f}s'.format(new['stages'][stage]) if stage in new['stages'] else '-',
+                change(old['stages'].get(stage), new['stages'].get(stage))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstTag', '1.0')
+from gi.repository import Gst, GstTag
+
+Gst.init(None)
+
+# One second of audio per buffer
+AUDIO = 'audiotestsrc wave={wave} num-buffers={seconds} samplesperbuffer=44100 ! audio/x-raw,rate=44100,channels=2 ! audioconvert'
+
+def video(width, height, frames, pattern = 'smpte'):
+    return 'videotestsrc pattern={} num-buffers={} ! video/x-raw,width={},height={},framerate=30/1 ! ' \
+           'videoconvert ! x264enc speed-preset=ultrafast key-int-max=60 ! h264parse'.format(pattern, frames, width, height)
+
+# Name to (file name, pipeline description writing to location, size of any image in pixels)
+FIXTURES = {
+    'audio_short': ('audio_short.ogg',
+        AUDIO.format(wave = 'pink-noise', seconds = 30) + ' ! vorbisenc ! oggmux ! filesink location="{location}"'),
+    'audio_long': ('audio_long.ogg',
+        AUDIO.format(wave = 'ticks', seconds = 30 * 60) + ' ! vorbisenc ! oggmux ! filesink location="{location}"'),
+    'video_1080p': ('video_1080p.mkv',
+        video(1920, 1080, 30 * 60) + ' ! matroskamux name=mux ! filesink location="{location}" ' +
+        AUDIO.format(wave = 'sine', seconds = 60) + ' ! vorbisenc ! mux.'),
+    'video_4k': ('video_4k.mkv',
+        video(3840, 2160, 30 * 20) + ' ! matroskamux name=mux ! filesink location="{location}" ' +
+        AUDIO.format(wave = 'sine', seconds = 20) + ' ! vorbisenc ! mux.'),
+    'large_still': ('large_still.jpg',
+        'videotestsrc pattern=zone-plate num-buffers=1 ! video/x-raw,width=12000,height=12000 ! videoconvert ! '
+        'jpegenc ! filesink location="{location}"'),
+    'cover_art': ('cover_art.flac',
+        AUDIO.format(wave = 'sine', seconds = 180) + ' ! flacenc name=encoder ! filesink location="{location}"'),
+    'multitrack': ('multitrack.mkv',
+        video(1280, 720, 30 * 30) + ' ! matroskamux name=mux ! filesink location="{location}" ' +
+        video(640, 360, 30 * 30, 'ball') + ' ! mux. ' +
+        AUDIO.format(wave = 'sine', seconds = 30) + ' ! vorbisenc ! mux. ' +
+        AUDIO.format(wave = 'pink-noise', seconds = 30) + ' ! vorbisenc ! mux.'),
+}
+
+def cover_image(directory):
+    '''Encodes a small JPEG to embed as cover art, returning it as an image tag sample'''
+    path = os.path.join(directory, 'cover.jpg')
+    run('videotestsrc pattern=snow num-buffers=1 ! video/x-raw,width=600,height=600 ! videoconvert ! '
+        'jpegenc ! filesink location="{}"'.format(path))
+
+    with open(path, 'rb') as fd:
+        data = fd.read()
+
+    os.unlink(path)
+    return GstTag.tag_image_data_to_image_sample(data, GstTag.TagImageType.FRONT_COVER)
+
+def run(description, setup = None):
+    pipeline = Gst.parse_launch(description)
+    if setup: setup(pipeline)
+
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+
+    if msg.type == Gst.MessageType.ERROR:
+        raise RuntimeError('Fixture pipeline failed: {}'.format(msg.parse_error()[0].message))
+
+def ensure_fixtures(directory, names = None):
+    '''Generates any fixtures missing from directory, returning a dict of name to path'''
+    os.makedirs(directory, exist_ok = True)
+    paths = {}
+
+    for name in names or FIXTURES:
+        filename, description = FIXTURES[name]
+        path = paths[name] = os.path.join(directory, filename)
+
+        if os.path.exists(path):
+            continue
+
+        logging.info('Generating fixture {}'.format(name))
+
+        setup = None
+        if name == 'cover_art':
+            tags = Gst.TagList.new_empty()
+            tags.add_value(Gst.TagMergeMode.APPEND, Gst.TAG_IMAGE, cover_image(directory))
+            setup = lambda pipeline: pipeline.get_by_name('encoder').merge_tags(tags, Gst.TagMergeMode.REPLACE)
+
+        # Written under a temporary name so an interrupted run doesn't leave a truncated fixture behind
+        tmp = path + '.tmp'
+        run(description.format(location = tmp), setup)
+        os.rename(tmp, path)
+
+    return paths
@@ -0,0 +1,183 @@
+'''Benchmarks Analyzer against synthetic media fixtures, saving the results as JSON
+
+Fixtures are generated with GStreamer test sources the first time they're
+needed, then served over HTTP from a local server. Every run happens in a
+fresh process, so peak RSS belongs to that run alone. The segmented mode's
+ReplayGain and BPM are checked against a single pass over the same fixture,
+and any that are out of tolerance are logged and saved with its results.
+
+    python -m benchmarks.run --output before.json
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+
+import asyncio
+
+from .fixtures import FIXTURES, ensure_fixtures
+from .server import FixtureServer
+
+from mediatool.audiomerge import tolerance_errors
+
+# Analyzer options for each way of running a job
+MODES = {
+    'staged': {},
+    'single_pass': {'single_pass': True},
+    'segmented': {'segment_audio': True},
+    'local': {},
+    'transcode': {'transcode': True, 'speed_preset': 'ultrafast'},
+}
+
+DEFAULT_MODES = ['staged', 'single_pass', 'local']
+
+def run_job(uri, options):
+    '''Analyzes uri in the current process, returning its measurements'''
+    import gbulb
+    gbulb.install()
+
+    from mediatool.analyze import Analyzer
+    from mediatool.timing import peak_rss
+
+    events = []
+    analyzer = Analyzer('benchmark', uri, emit = events.append, **options)
+
+    start = time.monotonic()
+    result = asyncio.get_event_loop().run_until_complete(analyzer.run())['result']
+    wall = time.monotonic() - start
+
+    # Clean up the poster, preview, waveform and rendition files left in the temporary directory
+    paths = [result.get(k) for k in ('poster', 'thumb', 'preview', 'preview_vtt', 'waveform')]
+    paths += [r['path'] for r in result.get('renditions', [])]
+    paths += [v['path'] for v in result.get('variants', [])]
+    for path in paths:
+        if path and os.path.exists(path): os.unlink(path)
+
+    return {
+        'type': result['type'],
+        'replaygain': result['metadata'].get('replaygain'),
+        'bpm': result['metadata'].get('bpm'),
+        'wall': round(wall, 3),
+        'peak_rss': peak_rss(),
+        'stages': [event['timing'] for event in events if 'timing' in event],
+    }
+
+def run_isolated(uri, options):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_job, (uri, options))
+
+def environment():
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'gstreamer': Gst.version_string(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+    }
+
+def summarize(fixture, mode, size, runs):
+    walls = [run['wall'] for run in runs]
+    wall = statistics.median(walls)
+
+    # Median of each stage's wall time across runs
+    stages = {}
+    for run in runs:
+        for stage in run['stages']:
+            stages.setdefault(stage['stage'], []).append(stage['wall'])
+
+    return {
+        'fixture': fixture,
+        'mode': mode,
+        'type': runs[0]['type'],
+        'replaygain': runs[0]['replaygain'],
+        'bpm': runs[0]['bpm'],
+        'size': size,
+        'wall': wall,
+        'walls': walls,
+        'throughput': round(size / wall / 2**20, 2) if wall else None,
+        'peak_rss': max(run['peak_rss'] for run in runs),
+        'stages': {name: statistics.median(w) for name, w in stages.items()},
+        'runs': runs,
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark Cedar Media Tool against synthetic fixtures')
+
+    parser.add_argument('--output', default = 'benchmark-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')),
+                        help = 'File to save the results to')
+    parser.add_argument('--fixtures-dir', default = os.path.join(tempfile.gettempdir(), 'mediatool-fixtures'),
+                        help = 'Directory fixtures are generated in and reused from')
+    parser.add_argument('--fixture', action = 'append', choices = sorted(FIXTURES),
+                        help = 'Fixture to benchmark, repeatable, all by default')
+    parser.add_argument('--mode', action = 'append', choices = sorted(MODES),
+                        help = 'Way of running jobs to benchmark, repeatable, {} by default'.format(', '.join(DEFAULT_MODES)))
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'Number of runs per fixture and mode, reported as their median')
+
+    return parser.parse_args(argv)
+
+def check_segmented(fixture, segmented, results, uri):
+    '''Compares the segmented mode's ReplayGain and BPM with a single pass's, running one if none was benchmarked'''
+    single = next((r for r in results if r['fixture'] == fixture and r['mode'] in ('single_pass', 'staged')), None)
+    if not single:
+        single = run_isolated(uri, MODES['staged'])
+
+    errors = tolerance_errors((segmented['replaygain'], segmented['bpm']), (single['replaygain'], single['bpm']))
+    for error in errors:
+        logging.warning('{} segmented: {}'.format(fixture, error))
+
+    segmented['tolerance_errors'] = errors
+
+def main(argv = None):
+    logging.basicConfig(level = logging.INFO)
+    args = parse_args(argv)
+
+    paths = ensure_fixtures(args.fixtures_dir, args.fixture)
+
+    server = FixtureServer(args.fixtures_dir)
+    server.start()
+
+    results = []
+
+    try:
+        for fixture, path in paths.items():
+            size = os.path.getsize(path)
+
+            for mode in args.mode or DEFAULT_MODES:
+                uri = path if mode == 'local' else server.url(os.path.basename(path))
+
+                runs = []
+                for i in range(args.repeat):
+                    runs.append(run_isolated(uri, MODES[mode]))
+                    logging.info('{} {} run {}: {:.3f}s'.format(fixture, mode, i + 1, runs[-1]['wall']))
+
+                results.append(summarize(fixture, mode, size, runs))
+
+                if mode == 'segmented':
+                    check_segmented(fixture, results[-1], results[:-1], uri)
+    finally:
+        server.stop()
+
+    with open(args.output, 'w') as fd:
+        json.dump({'environment': environment(), 'results': results}, fd, indent = 2)
+
+    logging.info('Saved results to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
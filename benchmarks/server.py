@@ -0,0 +1,45 @@
+import threading
+
+import asyncio
+from aiohttp import web
+
+class FixtureServer:
+    '''Serves a directory over HTTP with range support, from its own thread and event loop
+
+    Stands in for the Cedar server, so downloads are measured without any
+    network in the way.'''
+    def __init__(self, directory, host = '127.0.0.1', port = 0):
+        self.directory = directory
+        self.host = host
+        self.port = port
+
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.thread = None
+
+    def url(self, filename):
+        return 'http://{}:{}/{}'.format(self.host, self.port, filename)
+
+    async def start_app(self):
+        app = web.Application()
+        app.router.add_static('/', self.directory)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+        # Find out which port was picked if none was given
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self.loop.run_until_complete(self.start_app())
+
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
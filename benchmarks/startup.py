@@ -0,0 +1,103 @@
+'''Benchmarks how long it takes mediatool to start, saving the results as JSON
+
+Each case runs in a fresh interpreter, so nothing is already imported or
+initialized. The wall time covers the whole process, from starting Python
+until it exits, and the work time only the case itself. The results can be
+compared with benchmarks.compare like those of benchmarks.run.
+
+    python -m benchmarks.startup --output startup.json
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+import subprocess
+
+from .run import environment
+
+# Code each case runs, timed from inside the interpreter
+CASES = {
+    'import': 'import mediatool',
+    'help': 'from mediatool.cli import parse_args\n'
+            'try: parse_args(["--help"])\n'
+            'except SystemExit: pass',
+    'import_analyzer': 'from mediatool import Analyzer',
+    'gst_init': 'from mediatool.preflight import init_gst\n'
+                'init_gst()',
+    'preflight': 'from mediatool.preflight import check\n'
+                 'check()',
+}
+
+# Prints the measurements as the last line of output, after anything the case printed itself
+MEASURE = '''
+import time
+start = time.perf_counter()
+{}
+work = time.perf_counter() - start
+import json
+from mediatool.timing import peak_rss
+print(json.dumps({{"work": work, "peak_rss": peak_rss()}}))
+'''
+
+def run_case(code):
+    start = time.monotonic()
+    output = subprocess.check_output([sys.executable, '-c', MEASURE.format(code)],
+                                     cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    wall = time.monotonic() - start
+
+    measured = json.loads(output.decode().strip().splitlines()[-1])
+
+    return {
+        'wall': round(wall, 4),
+        'work': round(measured['work'], 4),
+        'peak_rss': measured['peak_rss'],
+    }
+
+def summarize(case, runs):
+    walls = [run['wall'] for run in runs]
+
+    return {
+        'fixture': 'startup',
+        'mode': case,
+        'wall': statistics.median(walls),
+        'walls': walls,
+        'peak_rss': max(run['peak_rss'] for run in runs),
+        'stages': {'work': statistics.median(run['work'] for run in runs)},
+        'runs': runs,
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark how long Cedar Media Tool takes to start')
+
+    parser.add_argument('--output', default = 'benchmark-startup-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')),
+                        help = 'File to save the results to')
+    parser.add_argument('--case', action = 'append', choices = sorted(CASES),
+                        help = 'Case to benchmark, repeatable, all by default')
+    parser.add_argument('--repeat', type = int, default = 10,
+                        help = 'Number of runs per case, reported as their median')
+
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    logging.basicConfig(level = logging.INFO)
+    args = parse_args(argv)
+
+    results = []
+
+    for case in args.case or CASES:
+        runs = [run_case(CASES[case]) for i in range(args.repeat)]
+        results.append(summarize(case, runs))
+
+        logging.info('{}: {:.3f}s, of which {:.3f}s was the case itself'.format(
+            case, results[-1]['wall'], results[-1]['stages']['work']))
+
+    with open(args.output, 'w') as fd:
+        json.dump({'environment': environment(), 'results': results}, fd, indent = 2)
+
+    logging.info('Saved results to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1 +1,4 @@
-import mediatool
+from mediatool.cli import main
+
+if __name__ == '__main__':
+    main()
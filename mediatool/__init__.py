@@ -1,16 +1,9 @@
-import asyncio
-import sys
-
-import logging
-#logging.basicConfig(level = logging.DEBUG)
-
-from .analyze import Analyzer
-
-import gbulb
-gbulb.install()
-
-async def go():
-    a = Analyzer(sys.argv[1], sys.argv[2])
-    print(await a.analyze())
-
-asyncio.get_event_loop().run_until_complete(go())
+def __getattr__(name):
+    # Analyzer pulls in GObject introspection and GStreamer, so importing the package
+    # stays cheap until it's actually asked for
+    if name == 'Analyzer':
+        from .analyze import Analyzer
+        globals()['Analyzer'] = Analyzer
+        return Analyzer
+    
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
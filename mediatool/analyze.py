@@ -1,180 +1,647 @@
 import os
 import json
+import hashlib
 import logging
+import pathlib
 import tempfile
+import urllib.parse
 
 import asyncio
-import aiohttp
-import socket
 
-from .tracks import TrackAndTagGetter
+from .tracks import TrackAndTagGetter, choose_poster_track
+from .engine import AnalysisEngine
 from .convert import FrameConverter
 from .grabber import FrameGrabber
-from .audioanalyzer import AudioAnalyzer
+from .audioanalyzer import AudioAnalyzer, SegmentedAudioAnalyzer
+from .spool import SpoolFile, SPOOL_URI, current_spool
+from .download import Downloader
+from .cache import cache_key
+from .transcoder import Transcoder, DEFAULT_RENDITIONS
+from .preview import PreviewGenerator, rename_sprite
+from .timing import StageTimer
+from .scheduler import StageTimeout, OPTIONAL_STAGES
+from .largeimage import LargeImageConverter, should_reduce, image_size, sample_data
+from .preflight import init_gst
+
+# Widths of the poster and thumbnail images
+POSTER_WIDTH = 1920
+THUMB_WIDTH = 256
 
 class Analyzer:
-    def __init__(self, _id, uri):
+    def __init__(self, _id, uri, single_pass = False, probe = True, stream = True, cache = None,
+                 downloader = None, shared_paths = (), memory_limit = 512 * 2**20, segment_audio = False,
+                 poster_candidates = 5, poster_budget = 2.0, preview = True,
+                 peaks_per_second = 20, transcode = False, renditions = DEFAULT_RENDITIONS,
+                 speed_preset = 'medium', encoder_threads = 0, timing = True,
+                 incremental = False, scheduler = None, degraded = False, fingerprint = True,
+                 image_formats = ('jpeg',), progressive = False, poster_target_size = None,
+                 thumb_target_size = None, min_quality = 60, emit = None):
+        init_gst()
+        
         self._id = _id
         self.uri = uri
+        self.single_pass = single_pass
+        self.probe = probe
+        self.stream = stream
+        
+        # A ResultCache keyed by the hash of the downloaded content and the options below, if any
+        self.cache = cache
+        self.hash = None
+        self.from_cache = False
+        
+        # Share one Downloader between Analyzers to reuse its connection pool
+        self.downloader = downloader
+        self.own_downloader = not downloader
+        
+        # (URI prefix, directory) pairs for storage that's mounted locally, so it can be read in place
+        self.shared_paths = shared_paths
+        
+        # Bytes a decoded image may take up before it's only decoded at reduced resolution
+        self.memory_limit = memory_limit
+        
+        # Split long audio into segments analyzed in parallel, trading exactness for wall time
+        self.segment_audio = segment_audio
+        
+        # Keyframes scored when choosing a video's poster frame, and seconds to spend trying them
+        self.poster_candidates = poster_candidates
+        self.poster_budget = poster_budget
+        
+        # Make a scrubbing preview sprite sheet and WebVTT index for videos
+        self.preview = preview
+        
+        # Resolution of the waveform peaks computed while analyzing audio, or 0 for none
+        self.peaks_per_second = peaks_per_second
+        
+        # Formats the poster and thumbnail are written in, the first being reported as poster and thumb,
+        # and optionally byte sizes to search for the highest quality under, down to min_quality
+        self.image_formats = image_formats
+        self.progressive = progressive
+        self.poster_target_size = poster_target_size
+        self.thumb_target_size = thumb_target_size
+        self.min_quality = min_quality
+        
+        # Compute perceptual hashes of the audio and the poster frame candidates, for finding near-duplicates
+        self.fingerprint = fingerprint
+        self.fingerprints = {}
+        
+        # Transcode videos to MP4 renditions, each a dict of name, height and bitrate
+        self.transcode = transcode
+        self.renditions = renditions
+        self.speed_preset = speed_preset
+        self.encoder_threads = encoder_threads
+        
+        # Called with each JSON-serializable progress message, printing them by default
+        self.emit = emit or (lambda msg: print(json.dumps(msg)))
+        
+        # Emit each part of the result as soon as it's ready, ahead of the complete result
+        self.incremental = incremental
+        
+        # Sets each stage's deadline, and whether to skip optional work because the machine is overloaded
+        self.scheduler = scheduler
+        self.degraded = degraded
+        
+        # Names of stages left out of the result, having been skipped or run out of time
+        self.skipped = []
+        
+        # Emits an event with the time and resources used as each stage finishes
+        self.timer = StageTimer(self.emit, timing)
         
         self.tracks = []
         self.metadata = {}
         self.duration = None
         
+        # Size of the media file in bytes, once known, for the deadlines of stages that run before the duration is
+        self.size = None
+        
         self.poster_sample = None
+        self.large_image = False
+        
+        self.waveform_path = ''
+        self.variants = []
+        
+        self.filename = None
+        self.media_path = None
+        self.download_task = None
+        
+        # Set when analysis reads the download as it arrives instead of waiting for it to finish
+        self.spool = None
+        self.spool_ready = None
+        self.source_setup = None
     
     def progress(self, amount):
-        print(json.dumps({'progress': amount}))
+        self.emit({'progress': amount})
     
-    async def download(self, uri, filename, force_ipv4 = False):
-        if force_ipv4:
-            conn = aiohttp.TCPConnector(family = socket.AF_INET)
-        else:
-            conn = aiohttp.TCPConnector()
+    def partial(self, fields):
+        '''Reports part of the result as soon as it's known, in incremental mode'''
+        if self.incremental:
+            self.emit({'partial': fields})
+    
+    async def stage(self, name, awaitable, fallback = None):
+        '''Awaits one stage of the job inside a timing span, within its deadline
+
+        If an optional stage runs out of time, it's skipped and fallback is
+        returned in place of its result.'''
+        with self.timer.span(name):
+            try:
+                if self.scheduler:
+                    # Time spent waiting on a streamed download doesn't count towards the deadline
+                    return await self.scheduler.run_stage(name, self.duration, awaitable, self.size,
+                                                          self.spool.waited if self.spool else None)
+                
+                return await awaitable
+            
+            except StageTimeout as e:
+                if name not in OPTIONAL_STAGES:
+                    raise
+                
+                logging.warning('{}, skipping it'.format(e))
+                self.skipped.append(name)
+                return fallback
+    
+    def download_started(self, size):
+        self.size = size
+        
+        # Pipelines can only read a spool file whose final size is known up front. With a cache,
+        # analysis waits for the content hash instead, so a duplicate doesn't run any pipelines.
+        if self.stream and size and not self.cache:
+            self.spool = SpoolFile(self.filename, size)
+            self.spool_ready.set_result(True)
+    
+    def download_progress(self, available):
+        if self.spool: self.spool.written(available)
+    
+    async def file_ready(self):
+        '''Waits until the whole media file is on disk, for stages that read it directly'''
+        if self.download_task:
+            await asyncio.shield(self.download_task)
+    
+    async def fetch(self, uri, filename):
+        self.hash = hashlib.blake2b()
         
-        async with aiohttp.ClientSession(connector = conn) as session:
-            async with session.get(uri) as resp:
-                with open(filename, 'wb') as fd:
-                    while True:
-                        chunk = await resp.content.read(10**6)
-                        if not chunk:
-                            break
-                        fd.write(chunk)
+        try:
+            await self.downloader.fetch(uri, filename, self.download_started, self.download_progress, self.hash)
+        finally:
+            if self.spool: self.spool.finish()
 
-    async def analyze(self):
-        self.progress(0)
+    def save_waveform(self, waveform):
+        if waveform and waveform.sample_rate:
+            self.waveform_path = os.path.join(self._dir, '{}.peaks.json'.format(self._id))
+            waveform.write(self.waveform_path)
+            logging.info('Saved waveform peaks')
+
+    def save_sketch(self, sketch):
+        fingerprint = sketch.fingerprint() if sketch else None
+        if fingerprint:
+            self.fingerprints['audio'] = fingerprint
+
+    async def analyze_single_pass(self):
+        # Tracks, tags, audio analysis and the poster frame all come from one decode of the file
+        engine = AnalysisEngine(self.uri, source_setup = self.source_setup, peaks_per_second = self.peaks_per_second,
+                                fingerprint = self.fingerprint)
+        self.tracks, self.metadata, self.duration, self.poster_sample = await self.stage('single_pass', engine.go())
         
-        logging.info('Downloading URI {} to cache'.format(self.uri))
-        _dir = tempfile.gettempdir()
+        self.save_waveform(engine.waveform)
+        self.save_sketch(engine.sketch)
+        
+        logging.info('Completed single pass analysis')
 
-        ext = self.uri.split('.')[-1]
-        filename = os.path.join(_dir, '{}.{}'.format(self._id, ext))
+    async def analyze_tracks(self):
+        if self.probe:
+            # Read the tracks from the container headers without starting any decoders
+            try:
+                self.tracks, self.metadata, self.duration, self.poster_sample = await self.stage('probe',
+                    TrackAndTagGetter(self.uri, probe = True, source_setup = self.source_setup).go())
+            except StageTimeout as e:
+                logging.warning('{}, decoding media to find its tracks instead'.format(e))
         
-        try:
-            await self.download(self.uri, filename)
-        except aiohttp.client_exceptions.ClientConnectorError:
-            await self.download(self.uri, filename, force_ipv4 = True)
+        if not self.tracks:
+            self.tracks, self.metadata, self.duration, self.poster_sample = await self.stage('tracks',
+                TrackAndTagGetter(self.uri, source_setup = self.source_setup).go())
         
-        self.uri = 'file://{}'.format(filename)
+        logging.info('Completed track and tag analysis')
+
+    async def analyze_audio(self):
+        # Audio analysis is also where waveform peaks and the audio fingerprint come from
+        if self.single_pass or not any(t['type'] == 'audio' for t in self.tracks) or not \
+           (self.metadata.get('replaygain') == None or self.metadata.get('bpm') == None or
+            self.peaks_per_second or self.fingerprint):
+            return
         
-        logging.info('Finished downloading URI to cache')
+        if self.segment_audio:
+            aa = SegmentedAudioAnalyzer(self.uri, self.duration, self.source_setup,
+                                        peaks_per_second = self.peaks_per_second, fingerprint = self.fingerprint)
+        else:
+            aa = AudioAnalyzer(self.uri, self.duration, self.source_setup,
+                               peaks_per_second = self.peaks_per_second, fingerprint = self.fingerprint)
         
-        self.progress(1 / 4)
+        logging.info('Starting audio analysis job')
+        replaygain, bpm = await self.stage('audio', aa.analyze(), (None, None))
+        if 'audio' in self.skipped:
+            return
         
-        logging.info('Starting analysis of URI {}'.format(self.uri))
+        if self.metadata.get('replaygain') == None:
+            self.metadata['replaygain'] = replaygain
         
-        self.tracks, self.metadata, self.duration, self.poster_sample = \
-            await TrackAndTagGetter(self.uri).go()
+        if self.metadata.get('bpm') == None:
+            self.metadata['bpm'] = bpm
         
-        logging.info('Completed track and tag analysis')
+        self.save_waveform(aa.waveform)
+        self.save_sketch(aa.sketch)
         
-        self.progress(2 / 4)
+        logging.info('Audio analysis complete')
         
-        # Start audio analysis
-        audiofuture = None
-        if any(t['type'] == 'audio' for t in self.tracks) and \
-           (self.metadata.get('replaygain') == None or self.metadata.get('bpm') == None):
-            aa = AudioAnalyzer(self.uri, self.duration)
-            audiofuture = asyncio.ensure_future(aa.analyze())
-            logging.info('Starting audio analysis job')
+        self.partial({'metadata': self.metadata, 'waveform': self.waveform_path})
 
+    async def grab_poster(self):
         # If metadata didn't contain a tag image, grab a frame from a video or image track if available
-        posterfuture = None
-        if not self.poster_sample:
-            best = None
-            
-            # Overly-complex track-selection logic on the tiny chance it gets fed media files with multiple video and image tracks
-            for track in self.tracks:
-                if track['type'] == 'video':
-                    if not best: best = track                        
-                    elif best['type'] == 'image': best = track
-                    elif best['type'] == 'video':
-                        if track['width'] * track['height'] > best['width'] * best['height']:
-                            best = track
-                
-                elif track['type'] == 'image':
-                    if not best: best = track                        
-                    elif best['type'] == 'image' and track['width'] * track['height'] > \
-                                                     best['width']  * best['height']:
-                        best = track
-            
-            if best:
-                logging.info('Starting poster frame grab job')
-                if best['type'] == 'video':
-                    # Grab a frame one-tenth of the way through the track
-                    pt = self.duration * 0.1
-                elif best['type'] == 'image':
-                    # Grab the first frame 'cause that's the only one. Duh.
-                    pt = 0
-                
-                grabber = FrameGrabber(self.uri, best['caps'], pt)
-                posterfuture = asyncio.ensure_future(grabber.grab())
-                
-
-        # Wait for audio tagging to complete, if in progress
-        if audiofuture:
-            replaygain, bpm = await audiofuture
+        if self.single_pass or self.poster_sample:
+            return
+        
+        best = choose_poster_track(self.tracks)
+        
+        if best and best['type'] == 'image' and should_reduce(best['caps'].get_structure(0).get_name(),
+                                                              best['width'], best['height'], self.memory_limit, POSTER_WIDTH):
+            # Don't decode a huge still at full size just to scale it down again
+            logging.info('Image is larger than the poster, it will be converted at reduced resolution')
+            self.large_image = True
+        
+        elif best:
+            logging.info('Starting poster frame grab job')
+            if best['type'] == 'video':
+                # Grab a frame one-tenth of the way through the track
+                pt = self.duration * 0.1
+            elif best['type'] == 'image':
+                # Grab the first frame 'cause that's the only one. Duh.
+                pt = 0
             
-            if self.metadata.get('replaygain') == None:
-                self.metadata['replaygain'] = replaygain
+            # Scoring candidates and hashing frames are optional work
+            candidates = 1 if self.degraded else self.poster_candidates
             
-            if self.metadata.get('bpm') == None:
-                self.metadata['bpm'] = bpm
+            grabber = FrameGrabber(self.uri, best['caps'], pt, best.get('stream-id'), self.source_setup,
+                                   candidates, self.poster_budget, self.duration,
+                                   self.fingerprint and not self.degraded)
+            self.poster_sample = await self.stage('poster_grab', grabber.grab())
+            
+            if grabber.hashes:
+                self.fingerprints[best['type']] = grabber.hashes
             
-            logging.info('Audio analysis complete')
-
-        # Wait for frame grabbing to complete, if in progress
-        if posterfuture:
-            self.poster_sample = await posterfuture
             logging.info('Poster frame grabbing complete')
+
+    async def finish_analysis(self, grab):
+        await self.analyze_audio()
+        await grab
         
         self.progress(3 / 4)
+
+    async def finish_poster(self, grab):
+        await grab
+        
+        # Waiting for the download isn't part of converting, so it's left out of the stage's deadline
+        if self.large_image:
+            await self.file_ready()
+        
+        posterpath, thumbpath = await self.stage('poster_convert', self.make_poster(), ('', ''))
+        self.partial({'poster': posterpath, 'thumb': thumbpath, 'variants': self.variants})
+        
+        return posterpath, thumbpath
+
+    async def analyze(self):
+        return json.dumps(await self.run())
+
+    def local_path(self, uri):
+        '''Finds the file behind uri if it's already on a local or shared filesystem'''
+        parsed = urllib.parse.urlparse(uri)
+        path = None
+        
+        if parsed.scheme == 'file':
+            path = urllib.parse.unquote(parsed.path)
+        
+        elif parsed.scheme == '' and os.path.isabs(uri):
+            path = uri
+        
+        else:
+            for prefix, directory in self.shared_paths:
+                if uri.startswith(prefix):
+                    relative = urllib.parse.unquote(uri[len(prefix):].split('?')[0])
+                    path = os.path.normpath(os.path.join(directory, relative.lstrip('/')))
+                    
+                    # Don't let a crafted URI escape the shared directory
+                    if not path.startswith(os.path.join(os.path.normpath(directory), '')):
+                        path = None
+                    break
+        
+        if path and os.path.isfile(path):
+            return path
+    
+    def result_key(self):
+        # Everything that changes what's in the result, as transcoding bypasses the cache
+        options = {
+            'single_pass': self.single_pass,
+            'probe': self.probe,
+            'segment_audio': self.segment_audio,
+            'poster_candidates': self.poster_candidates,
+            'poster_width': POSTER_WIDTH,
+            'thumb_width': THUMB_WIDTH,
+            'image_formats': list(self.image_formats),
+            'progressive': self.progressive,
+            'poster_target_size': self.poster_target_size,
+            'thumb_target_size': self.thumb_target_size,
+            'min_quality': self.min_quality,
+            'preview': self.preview,
+            'peaks_per_second': self.peaks_per_second,
+            'fingerprint': self.fingerprint,
+        }
+        
+        return cache_key(self.hash.hexdigest(), options)
+    
+    def cached_result(self):
+        # Once the content hash is known, a duplicate upload needs no further work,
+        # unless it's to be transcoded as renditions are too large to keep in the cache
+        if self.cache and not self.transcode:
+            result = self.cache.get(self.result_key(), self._dir, self._id)
+            if result:
+                # The cached WebVTT file still names the sprite sheet after the job that stored it
+                if result.get('preview_vtt'):
+                    rename_sprite(result['preview_vtt'], os.path.basename(result['preview']))
+                
+                self.from_cache = True
+                self.progress(4 / 4)
+                return {'result': result}
+    
+    async def run(self):
+        self.progress(0)
+        self._dir = tempfile.gettempdir()
+        
+        path = self.local_path(self.uri)
+        if path:
+            result = await self.run_in_place(path)
+        else:
+            result = await self.run_download()
+        
+        if self.timer.enabled:
+            result['result']['timing'] = self.timer.summary()
+        
+        # Results missing a stage, or with optional work cut when degraded, are left out,
+        # so the next job for the same content tries again
+        if self.cache and not self.from_cache and not self.skipped and not self.degraded:
+            cached = {k: v for k, v in result['result'].items() if not k in ('renditions', 'timing')}
+            self.cache.put(self.result_key(), cached, ['poster', 'thumb', 'variants', 'preview', 'preview_vtt', 'waveform'])
+        
+        return result
+    
+    async def run_in_place(self, path):
+        logging.info('Analyzing {} in place'.format(path))
         
-        if self.poster_sample:
-            logging.info('Starting poster and thumb frame convert and save jobs')
+        if self.cache:
+            self.hash = await self.stage('hash', asyncio.get_event_loop().run_in_executor(None, hash_file, path))
             
-            postertitle = '{}.poster.jpg'.format(self._id)
-            posterpath = os.path.join(_dir, postertitle)
-            pfc = FrameConverter(self.poster_sample, posterpath, max_width = 1920)
-            pfuture = asyncio.ensure_future(pfc.convert())
+            result = self.cached_result()
+            if result: return result
+        
+        # Only files we downloaded ourselves get deleted afterwards, so this one is left alone
+        self.uri = pathlib.Path(path).as_uri()
+        self.media_path = path
+        self.size = os.path.getsize(path)
+        return await self.analyze_media()
+    
+    async def run_download(self):
+        logging.info('Downloading URI {} to cache'.format(self.uri))
+        
+        ext = self.uri.split('.')[-1]
+        filename = self.filename = self.media_path = os.path.join(self._dir, '{}.{}'.format(self._id, ext))
+        
+        if self.own_downloader:
+            self.downloader = Downloader()
+        
+        self.spool_ready = asyncio.get_event_loop().create_future()
+        download = self.download_task = asyncio.ensure_future(self.stage('download', self.fetch(self.uri, filename)))
+        analysis = None
+        
+        try:
+            # Start analyzing as soon as the download can be streamed, or once it's finished otherwise
+            await asyncio.wait([download, self.spool_ready], return_when = asyncio.FIRST_COMPLETED)
+            
+            if self.spool and not download.done():
+                logging.info('Streaming URI to analysis while it downloads')
+                self.uri = SPOOL_URI
+                self.source_setup = self.spool.source_setup
+                
+                # The analysis task takes a copy of the context, so this only reaches this job's pipelines
+                current_spool.set(self.spool)
+                analysis = asyncio.ensure_future(self.analyze_media())
+            
+            await download
+            logging.info('Finished downloading URI to cache')
+            self.size = os.path.getsize(filename)
+            
+            result = self.cached_result()
+            if result: return result
+            
+            if not analysis:
+                self.uri = 'file://{}'.format(filename)
+                analysis = asyncio.ensure_future(self.analyze_media())
+            
+            return await analysis
+        finally:
+            for task in (download, analysis):
+                if task and not task.done():
+                    task.cancel()
+                    await asyncio.wait([task])
+            
+            if self.spool: self.spool.close()
+            if self.own_downloader: await self.downloader.close()
+            
+            # Delete cached file
+            if os.path.exists(filename): os.unlink(filename)
 
-            thumbtitle = '{}.thumb.jpg'.format(self._id)
-            thumbpath = os.path.join(_dir, thumbtitle)
-            tfc = FrameConverter(self.poster_sample, thumbpath, width = 256)
-            tfuture = asyncio.ensure_future(tfc.convert())
+    async def make_poster(self):
+        if self.poster_sample or self.large_image:
+            logging.info('Starting poster and thumb frame convert and save job')
+            
+            # Every format of both images comes from one decode of the poster
+            outputs = []
+            for format in self.image_formats:
+                ext = 'jpg' if format == 'jpeg' else format
+                
+                # Progressive JPEGs only come out smaller for images the size of a poster, not a thumbnail
+                outputs += [
+                    {'path': os.path.join(self._dir, '{}.poster.{}'.format(self._id, ext)), 'max_width': POSTER_WIDTH,
+                     'format': format, 'progressive': self.progressive, 'target_size': self.poster_target_size,
+                     'min_quality': self.min_quality},
+                    {'path': os.path.join(self._dir, '{}.thumb.{}'.format(self._id, ext)), 'width': THUMB_WIDTH,
+                     'format': format, 'target_size': self.thumb_target_size, 'min_quality': self.min_quality},
+                ]
+            
+            posterpath = outputs[0]['path']
+            thumbpath = outputs[1]['path']
+            
+            if self.large_image:
+                converter = LargeImageConverter(self.media_path, outputs, self.memory_limit,
+                                                self.fingerprint and not self.degraded)
             
-            await pfuture, tfuture
-            logging.info('Created poster and thumbnail images')
+            else:
+                converter = None
+                
+                # Embedded cover art can be huge too
+                format = self.poster_sample.get_caps().get_structure(0).get_name()
+                if format.startswith('image/'):
+                    data = sample_data(self.poster_sample)
+                    if should_reduce(format, *(image_size(data) or (0, 0)), self.memory_limit, POSTER_WIDTH):
+                        converter = LargeImageConverter(data, outputs, self.memory_limit)
+                
+                if not converter:
+                    converter = FrameConverter(self.poster_sample, outputs)
+            
+            converted = await converter.convert()
+            self.variants = converter.variants
+            
+            # The frame grabber hashes every other still, but skips these
+            if self.large_image and converter.hash:
+                self.fingerprints['image'] = [converter.hash]
+            
+            if converted:
+                logging.info('Created poster and thumbnail images')
+            else:
+                posterpath = ''
+                thumbpath = ''
         else:
             posterpath = ''
             thumbpath = ''
-                
-        logging.info('Finished analysis of URI {}'.format(self.uri))
         
-        self.progress(4 / 4)
+        return posterpath, thumbpath
+
+    async def make_preview(self):
+        best = choose_poster_track(self.tracks)
+        if not (self.preview and best and best['type'] == 'video' and self.duration):
+            return '', ''
+        
+        if self.degraded:
+            logging.info('Skipping preview sprite job while overloaded')
+            self.skipped.append('preview')
+            return '', ''
+        
+        logging.info('Starting preview sprite job')
+        
+        spritepath = os.path.join(self._dir, '{}.preview.jpg'.format(self._id))
+        vttpath = os.path.join(self._dir, '{}.preview.vtt'.format(self._id))
+        
+        generator = PreviewGenerator(self.uri, best, self.duration, spritepath, vttpath, source_setup = self.source_setup)
+        if await generator.generate():
+            logging.info('Created preview sprite sheet')
+            self.partial({'preview': spritepath, 'preview_vtt': vttpath})
+            return spritepath, vttpath
+        
+        return '', ''
+
+    async def make_renditions(self):
+        best = choose_poster_track(self.tracks)
+        if not (self.transcode and best and best['type'] == 'video' and self.duration):
+            return []
         
-        _type = 'invalid'
+        logging.info('Starting transcode job')
+        
+        renditions = [dict(r, path = os.path.join(self._dir, '{}.{}.mp4'.format(self._id, r['name'])))
+                      for r in self.renditions]
+        
+        transcoder = Transcoder(self.uri, best, any(t['type'] == 'audio' for t in self.tracks), self.duration,
+                                renditions, self.speed_preset, self.encoder_threads, source_setup = self.source_setup,
+                                on_progress = lambda amount: self.emit({'transcode_progress': amount}))
+        
+        renditions = await transcoder.transcode()
+        if renditions:
+            logging.info('Transcoded {} renditions'.format(len(renditions)))
+            self.partial({'renditions': renditions})
+        
+        return renditions
 
-        for track in self.tracks:
-            del track['caps']
+    async def analyze_media(self):
+        self.progress(1 / 4)
+        
+        logging.info('Starting analysis of URI {}'.format(self.uri))
+        
+        if self.single_pass:
+            await self.analyze_single_pass()
+        else:
+            await self.analyze_tracks()
+        
+        self.progress(2 / 4)
+        
+        self.partial({
+            'type': media_type(self.tracks),
+            'tracks': public_tracks(self.tracks),
+            'metadata': self.metadata,
+            'duration': self.duration,
+        })
+        
+        # Audio analysis and the poster don't depend on each other, so neither waits for the other.
+        # The preview and renditions need their own decodes of the video, so they run meanwhile too.
+        grab = asyncio.ensure_future(self.grab_poster())
+        tasks = [grab] + [asyncio.ensure_future(branch) for branch in (
+            self.finish_analysis(grab),
+            self.finish_poster(grab),
+            self.stage('preview', self.make_preview(), ('', '')),
+            self.stage('transcode', self.make_renditions(), []),
+        )]
+        
+        try:
+            _, (posterpath, thumbpath), (previewpath, vttpath), renditions = await asyncio.gather(*tasks[1:])
+        finally:
+            # If one branch fails the others are still running, and their pipelines must be
+            # stopped before the job reports the error and its downloaded file is deleted
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
             
-            # Determine the media type based on track types
-            if track['type'] == 'video':
-                _type = 'video'
-            elif track['type'] == 'audio' and not _type == 'video':
-                _type = 'audio'
-            elif track['type'] == 'image' and not _type == 'video' and not _type == 'audio':
-                _type = 'image'
+            if pending:
+                await asyncio.wait(pending)
+        
+        logging.info('Finished analysis of URI {}'.format(self.uri))
         
-        # Delete cached file
-        os.unlink(filename)
+        self.progress(4 / 4)
         
-        return json.dumps({
+        return {
             'result': {
-                'type': _type,
-                'tracks': self.tracks,
+                'type': media_type(self.tracks),
+                'tracks': public_tracks(self.tracks),
                 'metadata': self.metadata,
                 'poster': posterpath,
-                'thumb': thumbpath
+                'thumb': thumbpath,
+                'variants': self.variants,
+                'preview': previewpath,
+                'preview_vtt': vttpath,
+                'waveform': self.waveform_path,
+                'renditions': renditions,
+                'skipped': self.skipped,
+                'fingerprint': self.fingerprints
             }
-        })
+        }
+
+def media_type(tracks):
+    _type = 'invalid'
+    
+    for track in tracks:
+        # Determine the media type based on track types
+        if track['type'] == 'video':
+            _type = 'video'
+        elif track['type'] == 'audio' and not _type == 'video':
+            _type = 'audio'
+        elif track['type'] == 'image' and not _type == 'video' and not _type == 'audio':
+            _type = 'image'
+    
+    return _type
+
+def public_tracks(tracks):
+    '''Copies of the tracks without the fields only used internally'''
+    return [{k: v for k, v in track.items() if k not in ('caps', 'stream-id')} for track in tracks]
+
+def hash_file(path):
+    h = hashlib.blake2b()
+    
+    with open(path, 'rb') as fd:
+        while True:
+            chunk = fd.read(2**20)
+            if not chunk:
+                break
+            h.update(chunk)
+    
+    return h
@@ -1,3 +1,4 @@
+import os
 import logging
 import asyncio
 
@@ -5,36 +6,54 @@ import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 
+from .pipeline import PipelineWatcher
 from .taglist_utils import create_taglist_getters
+from .waveform import Waveform, PEAKS_BRANCH
+from .fingerprint import AudioSketch, SKETCH_BRANCH
+from .audiomerge import merge_replaygain, merge_bpm, bpm_confidence
 
 class AudioAnalyzer:
-    '''Analyzes audio for ReplayGain normalization and BPM detection'''
-    def __init__(self, uri, duration):
-        self.complete = False
-        self.progress = 0
-        
+    '''Analyzes audio for ReplayGain normalization and BPM detection
+
+    Given start and stop times, only that segment of the audio is analyzed.
+    Given peaks_per_second, the decoded audio is also reduced to waveform
+    peaks, kept in the waveform attribute. With fingerprint set, a sketch
+    for an audio fingerprint is kept in the sketch attribute.'''
+    def __init__(self, uri, duration, source_setup = None, start = None, stop = None, peaks_per_second = None,
+                 fingerprint = False):
         self.duration = duration
+        self.start = start
+        self.stop = stop
         
         self.replaygain = None
         self.bpm = None
         
-        self.pipeline = Gst.parse_launch(
-            'uridecodebin uri="{}" caps="audio/x-raw" expose-all-streams=false ! audioconvert ! rganalysis forced=false ! bpmdetect ! fakesink'.format(uri)
-        )
+        # Every BPM bpmdetect reported on its way to the final one
+        self.bpm_estimates = []
+        self.waveform = Waveform.create(peaks_per_second)
+        self.sketch = AudioSketch.create(fingerprint)
         
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.on_message)
-                
-    def on_message(self, bus, msg):
-        if msg.type == Gst.MessageType.ERROR:
-            logging.error('GStreamer error for audio analyzer: {}'.format(msg.parse_error()))
-            Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'audioanalyzer')
+        description = 'uridecodebin name=decodebin uri="{}" caps="audio/x-raw" expose-all-streams=false ! audioconvert ! tee name=tee ! queue ! rganalysis forced=false ! bpmdetect ! fakesink'.format(uri)
+        if self.waveform:
+            description += ' ' + PEAKS_BRANCH
+        if self.sketch:
+            description += ' ' + SKETCH_BRANCH
+        
+        self.pipeline = Gst.parse_launch(description)
+        
+        if self.waveform:
+            self.pipeline.get_by_name('peaks').connect('new-sample', self.waveform.new_sample)
+        if self.sketch:
+            self.pipeline.get_by_name('sketch').connect('new-sample', self.sketch.new_sample)
         
-        elif msg.type == Gst.MessageType.WARNING:
-            logging.warning('GStreamer warning for audio analyzer: {}'.format(msg.parse_error()))
+        if source_setup:
+            self.pipeline.get_by_name('decodebin').connect('source-setup', source_setup)
         
-        elif msg.type == Gst.MessageType.TAG:
+        self.watcher = PipelineWatcher(self.pipeline, 'audioanalyzer', 'audio analyzer')
+        self.watcher.bus.connect('message', self.on_message)
+                
+    def on_message(self, bus, msg):
+        if msg.type == Gst.MessageType.TAG:
             tag_list = msg.parse_tag()
             
             gs, gu, gd = create_taglist_getters(tag_list)
@@ -43,18 +62,79 @@ class AudioAnalyzer:
             if replaygain: self.replaygain = replaygain
             
             bpm = gd(Gst.TAG_BEATS_PER_MINUTE)
-            if bpm: self.bpm = round(bpm, 1)
+            if bpm:
+                self.bpm = round(bpm, 1)
+                self.bpm_estimates.append(bpm)
 
-        elif msg.type == Gst.MessageType.EOS:
-            self.complete = True
+    async def analyze(self):
+        try:
+            if self.start == None:
+                await self.watcher.run()
+            
+            elif await self.watcher.set_state(Gst.State.PAUSED) and \
+                 await self.watcher.seek(self.start, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE, self.stop):
+                await self.watcher.run()
+        finally:
+            self.watcher.stop()
+        
+        if self.waveform: self.waveform.finish()
+        
+        return self.replaygain, self.bpm
+
+class SegmentedAudioAnalyzer:
+    '''Analyzes long audio as segments in parallel pipelines, one per CPU core
 
+    The merged results are approximations of a single pass over the whole
+    track. ReplayGain takes the 95th percentile of short-block loudness over
+    the track, which can't be rebuilt from per-segment gains, so the merged
+    gain is expected to be within 1 dB of a single pass, or a little more on
+    material whose loudness varies widely between segments. The merged BPM
+    is expected to be within 3% of a single pass whenever most of the track
+    holds one tempo, with segments whose estimate kept changing given less
+    say. The tolerances are audiomerge's REPLAYGAIN_TOLERANCE and
+    BPM_TOLERANCE, which the benchmark's segmented mode checks. Waveform peaks are joined exactly, apart from one short
+    peak at the end of each segment, and so are fingerprint sketches.'''
+    def __init__(self, uri, duration, source_setup = None, segments = None, min_segment = 120 * Gst.SECOND,
+                 peaks_per_second = None, fingerprint = False):
+        self.uri = uri
+        self.duration = duration
+        self.source_setup = source_setup
+        self.peaks_per_second = peaks_per_second
+        self.fingerprint = fingerprint
+        self.waveform = None
+        self.sketch = None
+        
+        segments = segments or os.cpu_count() or 1
+        self.segments = max(1, min(segments, int((duration or 0) // min_segment)))
+    
     async def analyze(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
+        if self.segments == 1:
+            analyzer = AudioAnalyzer(self.uri, self.duration, self.source_setup,
+                                     peaks_per_second = self.peaks_per_second, fingerprint = self.fingerprint)
+            result = await analyzer.analyze()
+            self.waveform = analyzer.waveform
+            self.sketch = analyzer.sketch
+            return result
         
-        while not self.complete:
-            await asyncio.sleep(0.25)
+        logging.info('Analyzing audio as {} segments in parallel'.format(self.segments))
         
-        Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'audioanalyzer')
-        self.pipeline.set_state(Gst.State.NULL)
+        length = self.duration // self.segments
+        bounds = [(i * length, self.duration if i == self.segments - 1 else (i + 1) * length)
+                  for i in range(self.segments)]
         
-        return self.replaygain, self.bpm
+        analyzers = [AudioAnalyzer(self.uri, self.duration, self.source_setup, start, stop,
+                                   self.peaks_per_second, self.fingerprint)
+                     for start, stop in bounds]
+        results = await asyncio.gather(*[analyzer.analyze() for analyzer in analyzers])
+        
+        if all(analyzer.waveform for analyzer in analyzers):
+            self.waveform = Waveform.merge([analyzer.waveform for analyzer in analyzers])
+        
+        if all(analyzer.sketch for analyzer in analyzers):
+            self.sketch = AudioSketch.merge([analyzer.sketch for analyzer in analyzers])
+        
+        lengths = [stop - start for start, stop in bounds]
+        confidences = [bpm_confidence(analyzer.bpm_estimates) for analyzer in analyzers]
+        
+        return merge_replaygain([(gain, l) for (gain, bpm), l in zip(results, lengths)]), \
+               merge_bpm([(bpm, c) for (gain, bpm), c in zip(results, confidences)])
@@ -0,0 +1,82 @@
+import math
+
+# How close merged segment results are expected to be to a single pass over the whole track
+REPLAYGAIN_TOLERANCE = 1.0
+BPM_TOLERANCE = 0.03
+
+def bpm_confidence(estimates, tolerance = BPM_TOLERANCE):
+    '''Scores a segment's final BPM from 0 to 1 by how many of the estimates leading up to it agree with it
+
+    bpmdetect revises its estimate as it hears more of the audio. One that
+    settled early is more trustworthy than one still jumping around at the
+    end of the segment.'''
+    if not estimates:
+        return 0
+
+    final = estimates[-1]
+    return sum(1 for bpm in estimates if abs(bpm - final) <= final * tolerance) / len(estimates)
+
+def merge_replaygain(results):
+    '''Combines (gain, duration) pairs from segments into one track gain
+
+    Each gain is turned back into a relative loudness, and the loudnesses are
+    averaged as power weighted by segment duration.'''
+    results = [(gain, duration) for gain, duration in results if not gain == None]
+    if not results:
+        return None
+
+    total = sum(duration for gain, duration in results)
+    power = sum(duration * 10 ** (-gain / 10) for gain, duration in results) / total
+
+    return -10 * math.log10(power)
+
+def merge_bpm(results, tolerance = BPM_TOLERANCE):
+    '''Combines (bpm, confidence) pairs from segments by a confidence-weighted vote
+
+    Estimates within tolerance of a candidate support it fully, and estimates
+    at half or double its tempo support it at half weight, since beat trackers
+    commonly lock onto the wrong octave. The winner is the confidence-weighted
+    mean of the estimates that agree with the best-supported candidate.'''
+    results = [(bpm, confidence) for bpm, confidence in results if bpm and confidence > 0]
+    if not results:
+        return None
+
+    def near(a, b):
+        return abs(a - b) <= b * tolerance
+
+    best = None
+    for candidate, _ in results:
+        support = 0
+        for bpm, confidence in results:
+            if near(bpm, candidate):
+                support += confidence
+            elif near(bpm * 2, candidate) or near(bpm / 2, candidate):
+                support += confidence / 2
+
+        if not best or support > best[0]:
+            best = (support, candidate)
+
+    agreeing = [(bpm, confidence) for bpm, confidence in results if near(bpm, best[1])]
+    total = sum(confidence for bpm, confidence in agreeing)
+
+    return round(sum(bpm * confidence for bpm, confidence in agreeing) / total, 1)
+
+def tolerance_errors(merged, single):
+    '''Compares merged (gain, bpm) results with a single pass's, describing each that's out of tolerance
+
+    A value only one of them found counts as out of tolerance.'''
+    errors = []
+    (gain, bpm), (single_gain, single_bpm) = merged, single
+
+    if (gain == None) != (single_gain == None):
+        errors.append('ReplayGain {} where a single pass found {}'.format(gain, single_gain))
+    elif not gain == None and abs(gain - single_gain) > REPLAYGAIN_TOLERANCE:
+        errors.append('ReplayGain {:.2f} dB is more than {} dB from a single pass\'s {:.2f} dB'.format(
+            gain, REPLAYGAIN_TOLERANCE, single_gain))
+
+    if (bpm == None) != (single_bpm == None):
+        errors.append('BPM {} where a single pass found {}'.format(bpm, single_bpm))
+    elif not bpm == None and abs(bpm - single_bpm) > single_bpm * BPM_TOLERANCE:
+        errors.append('BPM {} is more than {:.0%} from a single pass\'s {}'.format(bpm, BPM_TOLERANCE, single_bpm))
+
+    return errors
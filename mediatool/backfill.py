@@ -0,0 +1,177 @@
+import os
+import csv
+import json
+import time
+import queue
+import logging
+import multiprocessing
+
+import asyncio
+
+def read_manifest(path):
+    '''Reads jobs from a CSV file with a header row, or from newline-delimited JSON objects
+
+    Each job needs an _id, or id, and a uri.'''
+    with open(path, newline = '') as fd:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(fd)
+        else:
+            rows = (json.loads(line) for line in fd if line.strip())
+
+        for row in rows:
+            _id = row.get('_id', row.get('id'))
+            if not _id or not row.get('uri'):
+                raise ValueError('Manifest entry needs an _id and a uri: {}'.format(row))
+
+            yield {'_id': _id, 'uri': row['uri']}
+
+def read_journal(path):
+    '''Returns the IDs of jobs the journal records as done'''
+    done = set()
+
+    try:
+        with open(path) as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short if the previous run was killed mid-write
+                    continue
+
+                if entry.get('status') == 'done':
+                    done.add(entry['_id'])
+    except FileNotFoundError:
+        pass
+
+    return done
+
+def serve_queue(jobs, results, concurrency, connections, options):
+    '''Runs in each backfill process, analyzing jobs from the queue on its own event loop'''
+    import gbulb
+    gbulb.install()
+
+    from .download import Downloader
+    from .worker import Worker
+
+    async def serve():
+        loop = asyncio.get_event_loop()
+
+        downloader = Downloader(connections)
+        worker = Worker(concurrency, downloader = downloader, **options)
+
+        def emit(msg):
+            # Progress and timing events stay in this process, only the outcome goes back
+            if 'result' in msg or 'error' in msg:
+                results.put(msg)
+
+        try:
+            while True:
+                job = await loop.run_in_executor(None, jobs.get)
+                if job == None:
+                    break
+
+                await worker.submit(json.dumps(job).encode(), emit)
+
+            await worker.drain()
+        finally:
+            await downloader.close()
+
+    asyncio.get_event_loop().run_until_complete(serve())
+
+class Backfill:
+    '''Reprocesses every job in a manifest across a pool of processes
+
+    Each process runs a Worker with several jobs in flight, taking jobs from
+    a shared queue so slow files don't hold up a whole shard. Outcomes are
+    appended to a newline-delimited JSON journal as they arrive, and jobs it
+    records as done are skipped when a run is resumed. Failed jobs are tried
+    again.'''
+    def __init__(self, manifest, journal = None, processes = None, concurrency = 4, connections = 4,
+                 options = None, report_interval = 10):
+        self.manifest = manifest
+        self.journal = journal or manifest + '.journal.jsonl'
+        self.processes = processes or os.cpu_count() or 1
+        self.concurrency = concurrency
+        self.connections = connections
+        self.options = options or {}
+        self.report_interval = report_interval
+
+    def report(self, finished, errors, total, start):
+        elapsed = time.monotonic() - start
+        rate = finished / elapsed if elapsed else 0
+
+        print(json.dumps({'backfill': {
+            'finished': finished,
+            'errors': errors,
+            'total': total,
+            'jobs_per_second': round(rate, 3),
+            'eta': round((total - finished) / rate) if rate else None,
+        }}), flush = True)
+
+    def pending(self):
+        '''Returns the manifest's jobs that the journal doesn't record as done, and the IDs of those that it does'''
+        done = read_journal(self.journal)
+        return [job for job in read_manifest(self.manifest) if job['_id'] not in done], done
+
+    def run(self):
+        jobs, done = self.pending()
+
+        logging.info('Backfilling {} jobs, {} already done'.format(len(jobs), len(done)))
+
+        context = multiprocessing.get_context('spawn')
+        job_queue = context.Queue()
+        results = context.Queue()
+
+        for job in jobs:
+            job_queue.put(job)
+
+        # One sentinel per process to tell it there's nothing left
+        for i in range(self.processes):
+            job_queue.put(None)
+
+        workers = [
+            context.Process(target = serve_queue, daemon = True,
+                            args = (job_queue, results, self.concurrency, self.connections, self.options))
+            for i in range(self.processes)
+        ]
+        for worker in workers: worker.start()
+
+        start = last_report = time.monotonic()
+        finished = errors = 0
+
+        try:
+            with open(self.journal, 'a') as fd:
+                while finished < len(jobs):
+                    try:
+                        msg = results.get(timeout = 1)
+                    except queue.Empty:
+                        if not any(worker.is_alive() for worker in workers):
+                            logging.error('Every backfill process exited with {} jobs unfinished'.format(
+                                len(jobs) - finished))
+                            break
+                        continue
+
+                    if 'error' in msg:
+                        entry = {'_id': msg.get('_id'), 'status': 'error', 'error': msg['error']}
+                        errors += 1
+                    else:
+                        entry = {'_id': msg['_id'], 'status': 'done', 'result': msg['result']}
+
+                    fd.write(json.dumps(entry) + '\n')
+                    fd.flush()
+                    finished += 1
+
+                    if time.monotonic() - last_report >= self.report_interval:
+                        self.report(finished, errors, len(jobs), start)
+                        last_report = time.monotonic()
+        finally:
+            for worker in workers:
+                # Give finished processes a moment to close their connections before stopping them
+                worker.join(timeout = 10 if finished == len(jobs) else 0)
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+
+        self.report(finished, errors, len(jobs), start)
+
+        return finished == len(jobs) and not errors
@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+# Bump whenever results change in a way entries stored by older versions don't reflect
+SCHEMA_VERSION = 1
+
+def cache_key(content_hash, options):
+    '''Returns the key for a result, from the hash of the media's contents and the options that shaped the result
+
+    options must be JSON-serializable. Identical content analyzed with
+    different options, or by a version with a different SCHEMA_VERSION, gets
+    a different entry.'''
+    digest = hashlib.blake2b(json.dumps([SCHEMA_VERSION, options], sort_keys = True).encode(), digest_size = 8)
+    return '{}-{}'.format(content_hash, digest.hexdigest())
+
+class ResultCache:
+    '''On-disk cache of analysis results and their images, keyed by cache_key
+
+    Each entry is a directory holding result.json and the files it refers to.
+    Entries are written to a temporary directory and renamed into place, so
+    readers never see a partial entry. The directory's mtime records when the
+    entry was last used, and the least recently used entries are evicted once
+    the cache grows past max_bytes.'''
+    def __init__(self, path, max_bytes = 5 * 10**9):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.path, exist_ok = True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, dest_dir, _id):
+        '''Returns the cached result for key with its files copied into dest_dir for _id, or None'''
+        entry = self.entry_path(key)
+
+        try:
+            with open(os.path.join(entry, 'result.json')) as fd:
+                cached = json.load(fd)
+
+            result = cached['result']
+            for field, name in cached['files'].items():
+                if isinstance(name, list):
+                    # A list of dicts, each with a path
+                    for item, item_name in zip(result[field], name):
+                        item['path'] = os.path.join(dest_dir, '{}.{}'.format(_id, item_name))
+                        link_or_copy(os.path.join(entry, item_name), item['path'])
+                else:
+                    path = os.path.join(dest_dir, '{}.{}'.format(_id, name))
+                    link_or_copy(os.path.join(entry, name), path)
+                    result[field] = path
+
+            os.utime(entry)
+
+        except (OSError, ValueError, KeyError):
+            # Missing, or evicted by another process while we were reading it
+            return None
+
+        logging.info('Found cached result {}'.format(key))
+        return result
+
+    def put(self, key, result, files):
+        '''Stores result under key, along with copies of the files named by the fields in files
+
+        A field can also hold a list of dicts, each naming a file by its path.'''
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return
+
+        tmp = tempfile.mkdtemp(prefix = '.tmp-', dir = self.path)
+
+        try:
+            cached = {'result': dict(result), 'files': {}}
+            for field in files:
+                value = result.get(field)
+                if not value: continue
+
+                if isinstance(value, list):
+                    cached['result'][field] = [dict(item, path = '') for item in value]
+                    cached['files'][field] = [self.store(item['path'], tmp) for item in value]
+                else:
+                    cached['files'][field] = self.store(value, tmp)
+                    cached['result'][field] = ''
+
+            with open(os.path.join(tmp, 'result.json'), 'w') as fd:
+                json.dump(cached, fd)
+
+            os.rename(tmp, entry)
+
+        except OSError as e:
+            # Most likely another job stored the same content first
+            logging.warning('Could not cache result {}: {}'.format(key, e))
+            shutil.rmtree(tmp, ignore_errors = True)
+            return
+
+        self.evict()
+
+    def store(self, path, tmp):
+        # Named by what follows the _id, e.g. poster.jpg
+        name = os.path.basename(path).split('.', 1)[-1]
+        link_or_copy(path, os.path.join(tmp, name))
+        return name
+
+    def evict(self):
+        entries = []
+        total = 0
+
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+                total += size
+            except OSError:
+                continue
+
+        entries.sort()
+
+        while total > self.max_bytes and entries:
+            mtime, size, path = entries.pop(0)
+            logging.info('Evicting cached result {}'.format(path))
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+
+def link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.unlink(dest)
+    
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
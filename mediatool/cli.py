@@ -0,0 +1,191 @@
+import sys
+import argparse
+import asyncio
+
+from .cache import ResultCache
+from .backfill import Backfill
+from .scheduler import Scheduler
+from . import preflight
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'Analyzes media files uploaded to a Cedar Server')
+    
+    parser.add_argument('_id', nargs = '?', help = 'ID of the media being analyzed')
+    parser.add_argument('uri', nargs = '?', help = 'URI to fetch the media from')
+    
+    parser.add_argument('--single-pass', action = 'store_true',
+                        help = 'Analyze tracks, audio and the poster frame in a single decode')
+    parser.add_argument('--no-probe', dest = 'probe', action = 'store_false',
+                        help = 'Decode media to find its tracks instead of only parsing it')
+    parser.add_argument('--segment-audio', action = 'store_true',
+                        help = 'Analyze long audio as segments in parallel, approximating ReplayGain and BPM')
+    parser.add_argument('--no-stream', dest = 'stream', action = 'store_false',
+                        help = 'Wait for the whole download before starting analysis')
+    
+    parser.add_argument('--connections', type = int, default = 4,
+                        help = 'Number of parallel range requests per download')
+    
+    parser.add_argument('--shared-path', action = 'append', default = [], metavar = 'PREFIX=DIR',
+                        help = 'Read URIs starting with PREFIX from the locally mounted DIR instead of downloading them')
+    
+    parser.add_argument('--memory-limit', type = int, default = 512,
+                        help = 'MB a decoded image may use at most, larger ones being decoded at reduced resolution or skipped')
+    
+    parser.add_argument('--poster-candidates', type = int, default = 5,
+                        help = 'Number of keyframes to score when choosing a video poster frame')
+    parser.add_argument('--poster-budget', type = float, default = 2.0,
+                        help = 'Seconds to spend trying poster frame candidates')
+    
+    parser.add_argument('--image-format', dest = 'image_formats', action = 'append', choices = ['jpeg', 'webp'],
+                        help = 'Format to write posters and thumbnails in, may be repeated, jpeg by default')
+    parser.add_argument('--progressive', action = 'store_true',
+                        help = 'Write progressive rather than baseline JPEG posters')
+    parser.add_argument('--poster-target-size', type = int,
+                        help = 'Largest size in KB to aim for when choosing poster quality')
+    parser.add_argument('--thumb-target-size', type = int,
+                        help = 'Largest size in KB to aim for when choosing thumbnail quality')
+    parser.add_argument('--min-quality', type = int, default = 60,
+                        help = 'Lowest quality to use when fitting images to a target size')
+    
+    parser.add_argument('--no-preview', dest = 'preview', action = 'store_false',
+                        help = 'Skip making scrubbing preview sprite sheets for videos')
+    
+    parser.add_argument('--peaks-per-second', type = int, default = 20,
+                        help = 'Resolution of the waveform peaks saved for audio, or 0 to skip them')
+    
+    parser.add_argument('--no-fingerprint', dest = 'fingerprint', action = 'store_false',
+                        help = 'Skip computing perceptual fingerprints for finding near-duplicates')
+    
+    parser.add_argument('--transcode', action = 'store_true',
+                        help = 'Transcode videos to H.264 MP4 renditions at several sizes')
+    parser.add_argument('--speed-preset', default = 'medium',
+                        help = 'x264 speed preset for renditions, e.g. veryfast or slow')
+    parser.add_argument('--encoder-threads', type = int, default = 0,
+                        help = 'Threads per x264 encoder, or 0 to choose automatically')
+    
+    parser.add_argument('--incremental', action = 'store_true',
+                        help = 'Emit each part of the result as soon as it is known, ahead of the complete result')
+    parser.add_argument('--no-timing', dest = 'timing', action = 'store_false',
+                        help = 'Skip emitting per-stage timing events and the timing summary in the result')
+    
+    parser.add_argument('--cache-dir', help = 'Directory to cache results in, keyed by content hash and options. '
+                        'Downloads are then only analyzed once complete, so duplicates are found first')
+    parser.add_argument('--cache-size', type = int, default = 5000,
+                        help = 'Size in MB the result cache is trimmed to')
+    
+    parser.add_argument('--worker', action = 'store_true',
+                        help = 'Process newline-delimited JSON jobs from stdin or --socket')
+    parser.add_argument('--socket', help = 'Unix socket path for worker mode to accept jobs on')
+    parser.add_argument('--jobs', type = int, default = 4,
+                        help = 'Number of jobs a worker analyzes concurrently')
+    
+    parser.add_argument('--deadline-scale', type = float, default = 1.0,
+                        help = 'Multiplies the deadline of every stage, or 0 to wait on stages forever')
+    parser.add_argument('--max-load', type = float, default = 1.0,
+                        help = 'Load average per CPU above which jobs skip optional stages')
+    parser.add_argument('--min-free-memory', type = int, default = 512,
+                        help = 'MB of free memory below which a worker holds back new jobs')
+    parser.add_argument('--min-free-disk', type = int, default = 1024,
+                        help = 'MB of free temporary disk space below which a worker holds back new jobs')
+    
+    parser.add_argument('--backfill', metavar = 'MANIFEST',
+                        help = 'Reprocess every _id and uri in a CSV or newline-delimited JSON manifest')
+    parser.add_argument('--journal', help = 'Where a backfill records finished jobs, MANIFEST.journal.jsonl by default')
+    parser.add_argument('--processes', type = int,
+                        help = 'Number of processes a backfill runs --jobs each in, one per CPU by default')
+    
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'Only check that the GStreamer elements analysis needs are installed')
+    parser.add_argument('--no-preflight', dest = 'preflight', action = 'store_false',
+                        help = 'Skip checking for required GStreamer elements before starting')
+    
+    args = parser.parse_args(argv)
+    
+    if not (args.worker or args.backfill or args.check) and not (args._id and args.uri):
+        parser.error('an _id and uri are required unless running with --worker or --backfill')
+    
+    if any('=' not in p for p in args.shared_path):
+        parser.error('--shared-path must be given as PREFIX=DIR')
+    args.shared_paths = [tuple(p.split('=', 1)) for p in args.shared_path]
+    
+    return args
+
+def analyzer_options(args):
+    options = {
+        'single_pass': args.single_pass,
+        'probe': args.probe,
+        'stream': args.stream,
+        'shared_paths': args.shared_paths,
+        'memory_limit': args.memory_limit * 2**20,
+        'segment_audio': args.segment_audio,
+        'poster_candidates': args.poster_candidates,
+        'poster_budget': args.poster_budget,
+        'image_formats': args.image_formats or ['jpeg'],
+        'progressive': args.progressive,
+        'poster_target_size': args.poster_target_size and args.poster_target_size * 1000,
+        'thumb_target_size': args.thumb_target_size and args.thumb_target_size * 1000,
+        'min_quality': args.min_quality,
+        'preview': args.preview,
+        'peaks_per_second': args.peaks_per_second,
+        'transcode': args.transcode,
+        'speed_preset': args.speed_preset,
+        'encoder_threads': args.encoder_threads,
+        'timing': args.timing,
+        'incremental': args.incremental,
+        'fingerprint': args.fingerprint,
+        'scheduler': Scheduler(args.max_load, args.min_free_memory * 2**20, args.min_free_disk * 2**20,
+                               args.deadline_scale),
+    }
+    
+    if args.cache_dir:
+        options['cache'] = ResultCache(args.cache_dir, args.cache_size * 10**6)
+    
+    return options
+
+async def go(args):
+    # Loading these loads GStreamer, so --help and argument errors don't wait for it
+    from .analyze import Analyzer
+    from .download import Downloader
+    from .worker import Worker
+    
+    options = analyzer_options(args)
+    downloader = options['downloader'] = Downloader(args.connections)
+    
+    try:
+        if args.worker:
+            worker = Worker(args.jobs, **options)
+            if args.socket:
+                await worker.serve_socket(args.socket)
+            else:
+                await worker.serve_stdin()
+        
+        else:
+            a = Analyzer(args._id, args.uri, **options)
+            print(await a.analyze())
+    finally:
+        await downloader.close()
+
+def main(argv = None):
+    #logging.basicConfig(level = logging.DEBUG)
+    args = parse_args(argv)
+    
+    # Fail before taking any jobs rather than on the first one that needs a missing element
+    if args.check or args.preflight:
+        ok = preflight.check(args.transcode)
+        
+        if args.check:
+            print('All required GStreamer elements are installed' if ok else 'Some required GStreamer elements are missing')
+        
+        if args.check or not ok:
+            sys.exit(0 if ok else 1)
+    
+    if args.backfill:
+        # Each backfill process runs its own event loop, so this one doesn't need any
+        options = dict(analyzer_options(args), incremental = False)
+        backfill = Backfill(args.backfill, args.journal, args.processes, args.jobs, args.connections, options)
+        sys.exit(0 if backfill.run() else 1)
+    
+    import gbulb
+    gbulb.install()
+    
+    asyncio.get_event_loop().run_until_complete(go(args))
@@ -1,3 +1,4 @@
+import os
 import logging
 import asyncio
 
@@ -6,59 +7,101 @@ gi.require_version('Gst', '1.0')
 gi.require_version('GstApp', '1.0')
 from gi.repository import Gst, GstApp
 
+from .pipeline import PipelineWatcher
+from .encode import Image, needs_pillow, sample_image, save_image, variant
+
+def output_size(output, srcwidth, srcheight):
+    '''Works out an output's dimensions from its width, height and max_width'''
+    width = output.get('width')
+    height = output.get('height')
+    max_width = output.get('max_width')
+    
+    if width == None:
+        width = srcwidth
+        height = srcheight
+    elif height == None:
+        ratio = srcwidth / srcheight
+        height = int(round(width / ratio))
+    
+    if max_width:
+        ratio = width / height
+        width = max_width
+        height = int(round(max_width / ratio))
+    
+    return width, height
+
 class FrameConverter:
-    '''Converts a Gst.Sample to a JPG file with specified dimensions'''
-    def __init__(self, sample, dest, width = None, height = None, max_width = None):
-        self.complete = False
-        
+    '''Converts a Gst.Sample to one or more image files with specified dimensions
+
+    Each output is a dict with a path, and optionally width, height, max_width
+    and quality. The sample is decoded and color-converted once, then teed to
+    a scaler and encoder per output. Outputs can also ask for a format of
+    webp, progressive JPEG, or a target_size in bytes with a min_quality.
+    These are scaled in the pipeline, then encoded in memory by Pillow, so
+    trying several qualities never decodes or scales the frame again. A
+    description of each file written is kept in variants.'''
+    def __init__(self, sample, outputs):
         self.sample = sample
         self.srccaps = sample.get_caps()
         self.struct = self.srccaps.get_structure(0)
         
-        self.dest = dest
+        self.outputs = []
+        for output in outputs:
+            if needs_pillow(output) and not Image:
+                if not output.get('format', 'jpeg') == 'jpeg':
+                    logging.warning('Pillow is unavailable, so {} cannot be written'.format(output['path']))
+                    continue
+                
+                output = dict(output, progressive = False, target_size = None)
+            
+            self.outputs.append(output)
+        
+        self.variants = []
+        
+        # Scaled raw frames for the outputs Pillow encodes, by output index
+        self.frames = {}
         
         srcwidth = self.struct.get_value('width')
         srcheight = self.struct.get_value('height')
         
-        if width == None:
-            self.width = srcwidth
-            self.height = srcheight
-        elif height == None:
-            self.width = width
-            ratio = srcwidth / srcheight
-            self.height = int(round(width / ratio))
-        else:
-            self.width = width
-            self.height = height
+        description = 'appsrc name=appsrc caps="{}" emit-signals=true ! tee name=src'.format(self.srccaps.to_string())
+        decoded = False
         
-        if max_width:
-            ratio = self.width / self.height
-            self.width = max_width
-            self.height = int(round(max_width / ratio))
+        for i, output in enumerate(self.outputs):
+            width, height = output_size(output, srcwidth, srcheight)
+            
+            if self.struct.get_name() == 'image/jpeg' and output.get('width') and output.get('height') and \
+               not needs_pillow(output):
+                description += ' src. ! queue ! filesink location="{}"'.format(output['path'])
+            
+            else:
+                if not decoded:
+                    description += ' src. ! queue ! decodebin ! videoconvert ! tee name=raw'
+                    decoded = True
+                
+                if needs_pillow(output):
+                    description += ' raw. ! queue ! videoscale method="lanczos" ! videoconvert ! {} ! ' \
+                                   'appsink name=frame{} emit-signals=true sync=false'.format(
+                        'video/x-raw, format=RGB, width={}, height={}, pixel-aspect-ratio=1/1'.format(width, height), i)
+                
+                else:
+                    description += ' raw. ! queue ! videoscale method="lanczos" ! jpegenc quality={} ! {} ! filesink location="{}"'.format(
+                        output.get('quality', 85),
+                        'image/jpeg, width={}, height={}, pixel-aspect-ratio=1/1'.format(width, height),
+                        output['path']
+                    )
         
-        if self.struct.get_name() == 'image/jpeg' and width and height:
-            self.pipeline = Gst.parse_launch(
-                'appsrc name=appsrc caps="{}" emit-signals=true ! filesink location={}'.format(
-                    self.srccaps.to_string(), self.dest
-                )
-        )
+        self.pipeline = Gst.parse_launch(description)
         
-        else:
-            self.pipeline = Gst.parse_launch(
-                'appsrc name=appsrc caps="{}" emit-signals=true ! decodebin ! videoconvert ! \
-                 videoscale method="lanczos" ! jpegenc ! {} ! filesink location="{}"'.format(
-                    self.srccaps.to_string(),
-                    'image/jpeg, width={}, height={}, pixel-aspect-ratio=1/1'.format(self.width, self.height),
-                    self.dest
-                )
-            )
-
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.on_message)
+        paths = ', '.join(output['path'] for output in self.outputs)
+        self.watcher = PipelineWatcher(self.pipeline, 'frameconverter', 'frame converter {}'.format(paths))
         
         self.appsrc = self.pipeline.get_by_name('appsrc')
         self.appsrc.connect('need-data', self.need_data)
+        
+        for i, output in enumerate(self.outputs):
+            if needs_pillow(output):
+                self.pipeline.get_by_name('frame{}'.format(i)).connect('new-sample', self.new_frame, i)
 
     def need_data(self, appsrc, arg1):
         if self.sample:
@@ -67,22 +110,29 @@ class FrameConverter:
         else:
             appsrc.end_of_stream()
     
-    def on_message(self, bus, msg):
-        if msg.type == Gst.MessageType.ERROR:
-            logging.error('GStreamer error for frame converter {}: {}'.format(self.dest, msg.parse_error()))
-            Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'frameconverter')
-        
-        elif msg.type == Gst.MessageType.WARNING:
-            logging.warning('GStreamer warning for frame converter {}: {}'.format(self.dest, msg.parse_error()))
-
-        elif msg.type == Gst.MessageType.EOS:
-            self.complete = True
+    def new_frame(self, appsink, i):
+        self.frames[i] = appsink.emit('pull-sample')
+        return Gst.FlowReturn.OK
+    
+    def encode_frames(self):
+        for i, output in enumerate(self.outputs):
+            if needs_pillow(output):
+                self.variants.append(save_image(sample_image(self.frames[i]), output))
+            else:
+                width, height = output_size(output, self.struct.get_value('width'), self.struct.get_value('height'))
+                self.variants.append(variant(output, width, height, output.get('quality', 85),
+                                             os.path.getsize(output['path'])))
     
     async def convert(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
-
-        while not self.complete:
-            await asyncio.sleep(0.25)
+        try:
+            if not await self.watcher.run():
+                return False
+        finally:
+            self.watcher.stop()
+        
+        if not len(self.frames) == sum(1 for output in self.outputs if needs_pillow(output)):
+            logging.error('Frame converter finished without a frame for every output')
+            return False
         
-        Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'frameconverter')
-        self.pipeline.set_state(Gst.State.NULL)
+        await asyncio.get_event_loop().run_in_executor(None, self.encode_frames)
+        return True
@@ -0,0 +1,276 @@
+import os
+import re
+import socket
+import logging
+import collections
+
+import asyncio
+import aiohttp
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+class DownloadError(Exception):
+    pass
+
+class Download:
+    '''A file being written by one or more concurrent range requests
+
+    Tracks how much of the file is on disk without gaps from its start, feeding
+    those bytes to an optional hasher in order and reporting each advance.'''
+    def __init__(self, filename, on_size = None, on_progress = None, hasher = None):
+        self.filename = filename
+        self.on_size = on_size
+        self.on_progress = on_progress
+        self.hasher = hasher
+
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+        self.size = None
+        self.available = 0
+
+        # Start of each range written past the gap-free prefix, mapped to how far it has got
+        self.pending = {}
+
+    def set_size(self, size):
+        self.size = size
+
+        if size:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, size)
+
+        if self.on_size: self.on_size(size)
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+
+    def wrote(self, start, end):
+        '''Records that the range beginning at start has been written up to end'''
+        self.pending[start] = max(end, self.pending.get(start, 0))
+
+        available = self.available
+        merged = True
+        while merged:
+            merged = False
+            for s, e in list(self.pending.items()):
+                if s <= available:
+                    available = max(available, e)
+                    del self.pending[s]
+                    merged = True
+
+        if available > self.available:
+            if self.hasher:
+                offset = self.available
+                while offset < available:
+                    data = os.pread(self.fd, min(available - offset, 2**20), offset)
+                    self.hasher.update(data)
+                    offset += len(data)
+
+            self.available = available
+            if self.on_progress: self.on_progress(available)
+
+    def close(self):
+        os.close(self.fd)
+
+class Downloader:
+    '''Fetches files over a shared pool of HTTP connections
+
+    When the server supports range requests, files larger than part_size are
+    split into parts fetched over several connections at once, lowest offsets
+    first so the start of the file is usable early. Interrupted parts resume
+    from their last written byte. Servers without range support, or that
+    don't say how large the file is, get a single stream, which on errors is
+    restarted and skips what's already on disk. Failed requests are retried
+    up to retries times, waiting retry_delay seconds before the first retry
+    and twice as long before each one after.'''
+    def __init__(self, connections = 4, part_size = 16 * 2**20, retries = 5, retry_delay = 1):
+        self.connections = connections
+        self.part_size = part_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.sessions = {}
+
+    def session(self, family = 0):
+        # One pooled session per address family, reused across downloads
+        if family not in self.sessions or self.sessions[family].closed:
+            self.sessions[family] = aiohttp.ClientSession(connector = aiohttp.TCPConnector(family = family))
+
+        return self.sessions[family]
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+
+        self.sessions = {}
+
+    async def request(self, uri, headers = None):
+        '''Makes the first request of a download, returning the response and the address family that worked
+
+        Connection errors, timeouts and server errors are retried, but other
+        error responses are raised straight away.'''
+        family = 0
+        attempt = 0
+
+        while True:
+            try:
+                try:
+                    resp = await self.session(family).get(uri, headers = headers)
+                except aiohttp.ClientConnectorError:
+                    if family:
+                        raise
+
+                    # Some hosts publish IPv6 addresses they can't be reached on
+                    family = socket.AF_INET
+                    resp = await self.session(family).get(uri, headers = headers)
+
+                if resp.status >= 400:
+                    resp.release()
+                    resp.raise_for_status()
+
+                return resp, family
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                    raise
+
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+                logging.warning('Retrying request for {} after error: {}'.format(uri, e))
+                await asyncio.sleep(self.retry_delay * 2**(attempt - 1))
+
+    async def fetch(self, uri, filename, on_size = None, on_progress = None, hasher = None):
+        download = Download(filename, on_size, on_progress, hasher)
+
+        try:
+            resp, family = await self.request(uri, {'Range': 'bytes=0-{}'.format(self.part_size - 1)})
+
+            match = CONTENT_RANGE.match(resp.headers.get('Content-Range', ''))
+            if resp.status == 206 and match and not match.group(3) == '*':
+                download.set_size(int(match.group(3)))
+                await self.fetch_parts(uri, family, download, resp, int(match.group(2)) + 1)
+                return download
+
+            if resp.status == 206:
+                # Without the total size, the part can't be told apart from the whole file, so ask for all of it
+                logging.info('Server did not give the size of {}, downloading it in one stream'.format(uri))
+                resp.release()
+                resp, family = await self.request(uri)
+
+                if resp.status == 206:
+                    resp.release()
+                    raise DownloadError('Server sent part of {} without being asked for a range'.format(uri))
+
+            download.set_size(resp.content_length)
+            await self.fetch_stream(uri, family, download, resp)
+
+        finally:
+            download.close()
+
+        return download
+
+    async def fetch_parts(self, uri, family, download, resp, first_end):
+        parts = collections.deque(
+            (start, min(start + self.part_size, download.size))
+            for start in range(first_end, download.size, self.part_size)
+        )
+
+        async def worker():
+            while parts:
+                start, end = parts.popleft()
+                await self.fetch_part(uri, family, download, start, end)
+
+        # The response to the first request is already streaming the first part
+        tasks = [asyncio.ensure_future(self.fetch_part(uri, family, download, 0, first_end, resp))]
+        tasks += [asyncio.ensure_future(worker()) for i in range(self.connections - 1)]
+
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks: task.cancel()
+            raise
+
+    async def fetch_part(self, uri, family, download, start, end, resp = None):
+        offset = start
+        attempt = 0
+
+        while offset < end:
+            try:
+                if resp is None:
+                    resp = await self.session(family).get(uri,
+                        headers = {'Range': 'bytes={}-{}'.format(offset, end - 1)})
+
+                async with resp:
+                    resp.raise_for_status()
+                    if not resp.status == 206:
+                        raise DownloadError('Server ignored range request for {}'.format(uri))
+
+                    while offset < end:
+                        chunk = await resp.content.read(2**20)
+                        if not chunk:
+                            break
+
+                        chunk = chunk[:end - offset]
+                        download.write(offset, chunk)
+                        offset += len(chunk)
+                        download.wrote(start, offset)
+
+                if offset < end:
+                    raise DownloadError('Bytes {}-{} of {} ended early'.format(offset, end - 1, uri))
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+                logging.warning('Resuming download of {} at byte {} after error: {}'.format(uri, offset, e))
+                await asyncio.sleep(self.retry_delay * 2**(attempt - 1))
+
+            finally:
+                resp = None
+
+    async def fetch_stream(self, uri, family, download, resp):
+        offset = 0
+        attempt = 0
+
+        while True:
+            try:
+                if resp is None:
+                    resp = await self.session(family).get(uri)
+
+                async with resp:
+                    resp.raise_for_status()
+
+                    # After a restart, skip over what's already been written
+                    position = 0
+                    while True:
+                        chunk = await resp.content.read(2**20)
+                        if not chunk:
+                            break
+
+                        if position + len(chunk) > offset:
+                            data = chunk[max(offset - position, 0):]
+                            download.write(offset, data)
+                            offset += len(data)
+                            download.wrote(0, offset)
+
+                        position += len(chunk)
+
+                if download.size and offset < download.size:
+                    raise DownloadError('Download of {} ended early at byte {}'.format(uri, offset))
+
+                return
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+                logging.warning('Restarting download of {} after error: {}'.format(uri, e))
+                await asyncio.sleep(self.retry_delay * 2**(attempt - 1))
+
+            finally:
+                resp = None
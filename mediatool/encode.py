@@ -0,0 +1,81 @@
+import io
+import logging
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+def needs_pillow(output):
+    '''Whether an output uses options only Pillow can encode, rather than jpegenc'''
+    return not output.get('format', 'jpeg') == 'jpeg' or output.get('progressive') or output.get('target_size')
+
+def sample_image(sample):
+    '''Wraps a raw RGB Gst.Sample as a Pillow image'''
+    struct = sample.get_caps().get_structure(0)
+    width = struct.get_value('width')
+    height = struct.get_value('height')
+
+    buf = sample.get_buffer()
+    data = buf.extract_dup(0, buf.get_size())
+
+    # Rows are padded out to the stride
+    return Image.frombuffer('RGB', (width, height), data, 'raw', 'RGB', len(data) // height, 1)
+
+def encode(image, format, quality, progressive):
+    buf = io.BytesIO()
+
+    if format == 'webp':
+        image.save(buf, 'WEBP', quality = quality)
+    else:
+        image.save(buf, 'JPEG', quality = quality, progressive = progressive, optimize = progressive)
+
+    return buf.getvalue()
+
+def variant(output, width, height, quality, size):
+    return {
+        'path': output['path'],
+        'format': output.get('format', 'jpeg'),
+        'width': width,
+        'height': height,
+        'quality': quality,
+        'size': size,
+    }
+
+def save_image(image, output):
+    '''Encodes a Pillow image that's already at the output's size, returning a description of the file written
+
+    Given a target_size in bytes, the highest quality that fits is found by
+    encoding in memory, never going below min_quality.'''
+    format = output.get('format', 'jpeg')
+    quality = output.get('quality', 85)
+    progressive = output.get('progressive', False)
+    target = output.get('target_size')
+
+    data = encode(image, format, quality, progressive)
+
+    if target and len(data) > target:
+        low, high = output.get('min_quality', 60), quality - 1
+        fitting = None
+
+        while low <= high:
+            q = (low + high) // 2
+            attempt = encode(image, format, q, progressive)
+
+            if len(attempt) <= target:
+                fitting = (q, attempt)
+                low = q + 1
+            else:
+                high = q - 1
+
+        if fitting:
+            quality, data = fitting
+        else:
+            quality = output.get('min_quality', 60)
+            data = encode(image, format, quality, progressive)
+            logging.info('{} is over its target size even at the minimum quality'.format(output['path']))
+
+    with open(output['path'], 'wb') as fd:
+        fd.write(data)
+
+    return variant(output, image.width, image.height, quality, len(data))
@@ -0,0 +1,174 @@
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .pipeline import PipelineWatcher
+from .tracks import parse_metadata, track_from_caps, choose_poster_track
+from .waveform import Waveform, PEAKS_BRANCH
+from .fingerprint import AudioSketch, SKETCH_BRANCH
+
+AUDIO_BRANCH = 'tee name=tee ! queue ! audioconvert ! rganalysis forced=false ! bpmdetect ! fakesink name=sink'
+FRAME_BRANCH = 'tee name=tee ! queue ! appsink name=sink sync=false emit-signals=true caps="video/x-raw"'
+
+def find_decoder(pad):
+    '''Follows a decodebin source pad back to the decoder element producing it, if any'''
+    while isinstance(pad, Gst.GhostPad):
+        pad = pad.get_target()
+
+    element = pad.get_parent_element() if pad else None
+    if element and element.get_factory() and \
+       'Decoder' in element.get_factory().get_metadata('klass'):
+        return element
+
+class AnalysisEngine:
+    '''Discovers tracks and tags, analyzes audio and grabs a poster frame from a single decode'''
+    def __init__(self, uri, poster_position = 0.1, source_setup = None, peaks_per_second = None, fingerprint = False):
+        self.uri = uri
+        self.poster_position = poster_position
+        self.waveform = Waveform.create(peaks_per_second)
+        self.sketch = AudioSketch.create(fingerprint)
+
+        self.tracks = []
+        self.metadata = {}
+        self.duration = None
+        self.poster_sample = None
+
+        self.audio_branch = None
+        self.frame_branches = []
+
+        self.pipeline = Gst.Pipeline.new()
+        self.watcher = PipelineWatcher(self.pipeline, 'engine', 'analysis engine {}'.format(self.uri))
+        self.watcher.bus.connect('message', self.on_message)
+
+        self.decodebin = Gst.ElementFactory.make('uridecodebin')
+        self.decodebin.connect('pad-added', self.pad_added)
+        self.decodebin.set_property('uri', self.uri)
+        if source_setup: self.decodebin.connect('source-setup', source_setup)
+
+        self.pipeline.add(self.decodebin)
+
+    async def go(self):
+        try:
+            # Preroll first so the duration, and with it the poster frame's position, is known
+            if await self.watcher.set_state(Gst.State.PAUSED):
+                res, duration = self.pipeline.query_duration(Gst.Format.TIME)
+                self.duration = duration if res else 0
+                logging.info('Media duration is {}'.format(self.duration))
+
+                await self.watcher.run()
+            else:
+                self.duration = 0
+                self.tracks = []
+        finally:
+            self.watcher.stop()
+
+        if self.waveform: self.waveform.finish()
+
+        if not self.poster_sample:
+            best = choose_poster_track(self.tracks)
+            for branch in self.frame_branches:
+                if branch['track'] is best:
+                    self.poster_sample = branch['sample']
+
+        return self.tracks, self.metadata, self.duration, self.poster_sample
+
+    def on_message(self, bus, msg):
+        if msg.type == Gst.MessageType.TAG:
+            tag_list = msg.parse_tag()
+
+            # Tags from the file arrive before the analysis results, and should take precedence
+            for k, v in parse_metadata(tag_list).items():
+                if k in ('replaygain', 'bpm') and not self.metadata.get(k) == None:
+                    continue
+                self.metadata[k] = v
+
+            if not self.poster_sample:
+                found, sample = tag_list.get_sample(Gst.TAG_IMAGE)
+                if found:
+                    logging.info('Found poster image in file tag')
+                    self.poster_sample = sample
+
+    def poster_time(self, branch):
+        if branch['track']['type'] == 'image':
+            # Grab the first frame 'cause that's the only one. Duh.
+            return 0
+
+        if self.duration == None:
+            res, duration = self.pipeline.query_duration(Gst.Format.TIME)
+            if not res: return 0
+            self.duration = duration
+
+        # Grab a frame one-tenth of the way through the track
+        return int(self.duration * self.poster_position)
+
+    def add_branch(self, pad, description):
+        branch = Gst.parse_bin_from_description(description, True)
+        self.pipeline.add(branch)
+        pad.link(branch.get_static_pad('sink'))
+        branch.sync_state_with_parent()
+
+        return branch
+
+    def pad_added(self, decodebin, pad):
+        caps = pad.get_current_caps()
+        if not caps: return
+
+        track = track_from_caps(caps)
+        track['stream-id'] = pad.get_stream_id()
+        self.tracks.append(track)
+
+        decoder = find_decoder(pad)
+
+        if track['type'] == 'audio' and not self.audio_branch:
+            description = AUDIO_BRANCH
+            if self.waveform: description += ' ' + PEAKS_BRANCH
+            if self.sketch: description += ' ' + SKETCH_BRANCH
+
+            self.audio_branch = self.add_branch(pad, description)
+
+            if self.waveform:
+                self.audio_branch.get_by_name('peaks').connect('new-sample', self.waveform.new_sample)
+            if self.sketch:
+                self.audio_branch.get_by_name('sketch').connect('new-sample', self.sketch.new_sample)
+
+        elif track['type'] in ('video', 'image'):
+            branch = {'track': track, 'sample': None, 'done': False}
+            self.frame_branches.append(branch)
+
+            bin = self.add_branch(pad, FRAME_BRANCH)
+            bin.get_by_name('sink').connect('new-sample', self.new_sample, branch)
+
+            # Only feed the decoder keyframes until the poster frame has passed, then nothing at all
+            if decoder:
+                decoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.decoder_probe, branch)
+
+        else:
+            # Nothing to do with this track, so don't waste any time decoding it
+            fake = Gst.ElementFactory.make('fakesink')
+            self.pipeline.add(fake)
+            pad.link(fake.get_static_pad('sink'))
+            fake.sync_state_with_parent()
+
+            if decoder:
+                decoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+                    lambda pad, info: Gst.PadProbeReturn.DROP)
+
+    def decoder_probe(self, pad, info, branch):
+        if branch['done'] or info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+            return Gst.PadProbeReturn.DROP
+
+        return Gst.PadProbeReturn.OK
+
+    def new_sample(self, appsink, branch):
+        sample = appsink.emit('pull-sample')
+
+        if sample and not branch['done']:
+            # Keep the latest keyframe in case the stream ends before the poster position
+            branch['sample'] = sample
+
+            if sample.get_buffer().pts >= self.poster_time(branch):
+                branch['done'] = True
+
+        return Gst.FlowReturn.OK
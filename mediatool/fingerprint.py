@@ -0,0 +1,83 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .pcmtap import PCMTap, tap_branch
+
+# Sketches are hashed from a DCT of this many rows and columns, keeping the lowest 8x8 frequencies
+DCT_SIZE = 32
+HASH_SIZE = 8
+
+SKETCH_RATE = 11025
+SKETCH_BRANCH = tap_branch('sketch', SKETCH_RATE)
+
+# Samples per spectrum, and the edges in Hz of the bands their energy is summed over
+SKETCH_FRAME = 2048
+SKETCH_BANDS = 32
+SKETCH_LOW, SKETCH_HIGH = 300, 3000
+
+def shrink(a, rows, cols):
+    '''Resizes a 2D array by averaging blocks, first repeating rows or columns if there are too few'''
+    a = np.repeat(a, -(-rows // a.shape[0]), axis = 0)
+    a = np.repeat(a, -(-cols // a.shape[1]), axis = 1)
+
+    a = np.array([block.mean(axis = 0) for block in np.array_split(a, rows, axis = 0)])
+    return np.array([block.mean(axis = 1) for block in np.array_split(a, cols, axis = 1)]).T
+
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+def phash(a):
+    '''Hashes a 2D array, like a grayscale image or a spectrogram, to 64 bits as 16 hex digits
+
+    Arrays that look alike give hashes a small Hamming distance apart, even
+    after scaling, recompression or small changes of brightness.'''
+    d = dct_matrix(DCT_SIZE)
+    freq = d @ shrink(a.astype(np.float32), DCT_SIZE, DCT_SIZE) @ d.T
+
+    low = freq[:HASH_SIZE, :HASH_SIZE].flatten()
+
+    # The DC term only says how bright the whole thing is, so it's left out of the median
+    bits = low > np.median(low[1:])
+    return '{:016x}'.format(int(''.join('1' if bit else '0' for bit in bits), 2))
+
+class AudioSketch(PCMTap):
+    '''Builds a perceptual hash of audio from the energy in bands of its spectrum over time
+
+    Connect new_sample to the new-sample signal of the appsink in
+    SKETCH_BRANCH. The log band energies of every frame form a spectrogram,
+    which is hashed like an image. Requires NumPy.'''
+    what = 'audio fingerprints'
+
+    block_size = SKETCH_FRAME
+
+    def __init__(self):
+        super().__init__()
+
+        freqs = np.fft.rfftfreq(SKETCH_FRAME, 1 / SKETCH_RATE)
+        edges = np.geomspace(SKETCH_LOW, SKETCH_HIGH, SKETCH_BANDS + 1)
+        self.bins = np.searchsorted(freqs, edges)
+        self.window = np.hanning(SKETCH_FRAME)
+
+    def add_blocks(self, blocks):
+        power = np.abs(np.fft.rfft(blocks * self.window)) ** 2
+
+        bands = np.add.reduceat(power[:, :self.bins[-1]], self.bins[:-1], axis = 1)
+        self.chunks.append(np.log1p(bands))
+
+    def fingerprint(self):
+        '''Returns the hash as 16 hex digits, or None if there wasn't enough audio'''
+        if not self.chunks:
+            return None
+
+        spectrogram = np.concatenate(self.chunks)
+        if len(spectrogram) < HASH_SIZE:
+            return None
+
+        return phash(spectrogram)
@@ -0,0 +1,131 @@
+import os
+import json
+import itertools
+import statistics
+
+# Hashes are 64 bits, indexed as this many chunks of 16 bits each
+CHUNKS = 4
+CHUNK_BITS = 16
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def chunks(value):
+    return [(value >> (i * CHUNK_BITS)) & (2**CHUNK_BITS - 1) for i in range(CHUNKS)]
+
+def neighbours(chunk, radius):
+    '''Every chunk value within radius bits of chunk'''
+    for r in range(radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), r):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+class FingerprintIndex:
+    '''Finds the stored item whose fingerprints are nearest to a new one's, by Hamming distance
+
+    Fingerprints are the dicts Analyzer returns, mapping a kind (audio,
+    video or image) to one 64-bit hash or a list of them, as hex. Hashes are
+    found by multi-index search: split into 4 chunks, any hash within
+    max_distance bits must have a chunk within max_distance // 4 bits of the
+    query's, so only items sharing such a chunk are compared in full. Items
+    are appended to a newline-delimited JSON file at path, if given, and
+    loaded from it again on startup.'''
+    def __init__(self, path = None, max_distance = 10):
+        self.path = path
+        self.max_distance = max_distance
+
+        # _id to {kind: [hashes as ints]}
+        self.items = {}
+
+        # One table per kind and chunk position, from chunk value to the _ids having it
+        self.tables = {}
+
+        if path and os.path.exists(path):
+            with open(path) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    self.insert(entry['_id'], entry['fingerprint'])
+
+    def remove(self, _id):
+        item = self.items.pop(_id, {})
+
+        for kind, hashes in item.items():
+            for h in hashes:
+                for i, chunk in enumerate(chunks(h)):
+                    # Two of an item's hashes can share a chunk, so it may already be gone
+                    table = self.tables[(kind, i)]
+                    ids = table.get(chunk, set())
+                    ids.discard(_id)
+                    if not ids:
+                        table.pop(chunk, None)
+
+    def insert(self, _id, fingerprint):
+        # Replacing an item's fingerprint mustn't leave its old hashes findable
+        self.remove(_id)
+
+        item = self.items[_id] = {}
+
+        for kind, hashes in fingerprint.items():
+            hashes = [int(h, 16) for h in (hashes if isinstance(hashes, list) else [hashes])]
+            item[kind] = hashes
+
+            for h in hashes:
+                for i, chunk in enumerate(chunks(h)):
+                    self.tables.setdefault((kind, i), {}).setdefault(chunk, set()).add(_id)
+
+    def add(self, _id, fingerprint):
+        '''Indexes an item's fingerprint, saving it if the index has a path'''
+        if not fingerprint:
+            return
+
+        self.insert(_id, fingerprint)
+
+        if self.path:
+            with open(self.path, 'a') as fd:
+                fd.write(json.dumps({'_id': _id, 'fingerprint': fingerprint}) + '\n')
+
+    def candidates(self, kind, h):
+        found = set()
+
+        for i, chunk in enumerate(chunks(h)):
+            table = self.tables.get((kind, i), {})
+            for neighbour in neighbours(chunk, self.max_distance // CHUNKS):
+                found |= table.get(neighbour, set())
+
+        return found
+
+    def distance(self, query, item):
+        '''Mean over the kinds both have of the median distance from each query hash to its closest match'''
+        distances = []
+
+        for kind, hashes in query.items():
+            if kind in item:
+                distances.append(statistics.median(min(hamming(h, other) for other in item[kind]) for h in hashes))
+
+        return sum(distances) / len(distances) if distances else None
+
+    def nearest(self, fingerprint, exclude = None):
+        '''Returns the _id and distance of the nearest item within max_distance bits, or None'''
+        query = {kind: [int(h, 16) for h in (hashes if isinstance(hashes, list) else [hashes])]
+                 for kind, hashes in (fingerprint or {}).items()}
+
+        found = set()
+        for kind, hashes in query.items():
+            for h in hashes:
+                found |= self.candidates(kind, h)
+
+        found.discard(exclude)
+
+        best = None
+        for _id in found:
+            distance = self.distance(query, self.items[_id])
+            if distance != None and distance <= self.max_distance and (not best or distance < best[1]):
+                best = (_id, distance)
+
+        return best
@@ -1,3 +1,4 @@
+import time
 import logging
 import asyncio
 
@@ -5,27 +6,110 @@ import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .pipeline import PipelineWatcher
+from .fingerprint import phash
+
+# Candidate frames are scored on a grayscale copy this many pixels wide
+SCORE_WIDTH = 160
+
+# Fractions of the duration videos are hashed at. They're the same for every file and
+# seeked to accurately, so two encodes of one video are hashed at the same frames.
+HASH_POINTS = (0.1, 0.3, 0.5, 0.7, 0.9)
+
+def sample_luma(sample):
+    '''Returns a GRAY8 sample's pixels as a 2D array'''
+    struct = sample.get_caps().get_structure(0)
+    width = struct.get_value('width')
+    height = struct.get_value('height')
+    
+    buf = sample.get_buffer()
+    data = buf.extract_dup(0, buf.get_size())
+    
+    # Rows are padded out to the stride
+    return np.frombuffer(data, np.uint8).reshape(height, len(data) // height)[:, :width]
+
+def score_frame(luma):
+    '''Scores a frame's suitability as a poster, preferring well-exposed, detailed and sharp frames'''
+    f = luma.astype(np.float32)
+    
+    mean = f.mean()
+    variance = f.var()
+    
+    # Blurred and flat frames have little energy in their gradients
+    edges = np.abs(np.diff(f, axis = 0)).mean() + np.abs(np.diff(f, axis = 1)).mean()
+    exposure = 1 - abs(mean - 128) / 128
+    
+    score = np.sqrt(variance) * edges * (0.5 + 0.5 * exposure)
+    
+    # Black fades, white flashes and blank cards lose to any real frame
+    if mean < 16 or mean > 240 or variance < 64:
+        score *= 0.01
+    
+    return float(score)
+
 class FrameGrabber:
-    '''Grabs a frame from a video track'''
-    def __init__(self, uri, targetcaps, targettime):
-        self.complete = False
+    '''Grabs a frame from a video track
+
+    With several candidates, keyframes spread from targettime to 60% of the
+    duration are scored on a downscaled grayscale copy and the best one is
+    returned at full resolution. Candidates stop being tried once budget
+    seconds have passed, or one takes longer than what's left of it. With
+    fingerprint set, perceptual hashes of the frames at HASH_POINTS of the
+    duration, or of a still's only frame, are kept in hashes, with another
+    budget seconds shared by all the seeks for them.'''
+    def __init__(self, uri, targetcaps, targettime, stream_id = None, source_setup = None,
+                 candidates = 1, budget = None, duration = None, fingerprint = False):
         self.sample = None
         
+        # Tracks found by probing carry compressed caps, so they're matched by stream ID instead
         self.targetcaps = targetcaps
         self.targettime = targettime
+        self.stream_id = stream_id
+        
+        if (candidates > 1 or fingerprint) and not np:
+            logging.warning('NumPy is unavailable, so poster frame candidates cannot be scored or hashed')
+            candidates = 1
+            fingerprint = False
+        
+        if candidates > 1 and targettime and duration:
+            end = duration * 0.6
+            self.positions = [int(targettime + (end - targettime) * i / (candidates - 1)) for i in range(candidates)]
+        else:
+            self.positions = [targettime]
+        
+        self.budget = budget
+        self.scores = []
+        
+        self.fingerprint = fingerprint
+        self.hashes = []
+        
+        if not fingerprint:
+            self.hash_positions = []
+        elif duration:
+            self.hash_positions = [int(duration * point) for point in HASH_POINTS]
+        elif targettime == 0:
+            self.hash_positions = [0]
+        else:
+            self.hash_positions = []
+        
+        # The position the pipeline is prerolled at exactly, if it's known
+        self.prerolled = 0
         
         self.appsink = None
-        self.seeked = targettime == 0 # Don't seek if targettime is 0
+        self.scaledsink = None
 
         self.pipeline = Gst.Pipeline.new()
-        
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.on_message)
+        self.watcher = PipelineWatcher(self.pipeline, 'framegrabber', 'frame grabber')
         
         self.decodebin = Gst.ElementFactory.make('uridecodebin')
         self.decodebin.set_property('uri', uri)
         self.decodebin.connect('pad-added', self.pad_added)
+        if source_setup: self.decodebin.connect('source-setup', source_setup)
         
         self.pipeline.add(self.decodebin)
         
@@ -33,53 +117,113 @@ class FrameGrabber:
         caps = pad.get_current_caps()
         
         if caps:
-            if caps.is_equal(self.targetcaps) and not self.appsink:
-                self.appsink = Gst.ElementFactory.make('appsink')
-                self.appsink.set_property('emit-signals', True)
-                self.appsink.set_property('drop', True)
-                self.appsink.set_property('caps', Gst.Caps.from_string('video/x-raw'))
-                self.appsink.connect('new-preroll', self.grab_frame)
+            if self.stream_id:
+                target = pad.get_stream_id() == self.stream_id
+            else:
+                target = caps.is_equal(self.targetcaps)
+            
+            if target and not self.appsink:
+                if len(self.positions) > 1 or self.fingerprint:
+                    branch = Gst.parse_bin_from_description(
+                        'tee name=tee ! queue ! appsink name=full drop=true caps="video/x-raw" '
+                        'tee. ! queue ! videoconvert ! videoscale ! video/x-raw,format=GRAY8,width={} ! '
+                        'appsink name=scaled drop=true'.format(SCORE_WIDTH), True)
+                    
+                    self.appsink = branch.get_by_name('full')
+                    self.scaledsink = branch.get_by_name('scaled')
+                else:
+                    branch = self.appsink = Gst.ElementFactory.make('appsink')
+                    self.appsink.set_property('drop', True)
+                    self.appsink.set_property('caps', Gst.Caps.from_string('video/x-raw'))
                 
-                self.pipeline.add(self.appsink)
-                pad.link(self.appsink.get_static_pad('sink'))
-                self.appsink.set_state(Gst.State.PAUSED)
+                self.pipeline.add(branch)
+                pad.link(branch.get_static_pad('sink'))
+                branch.sync_state_with_parent()
             else:
                 fake = Gst.ElementFactory.make('fakesink')
                 self.pipeline.add(fake)
                 pad.link(fake.get_static_pad('sink'))
-                fake.set_state(Gst.State.PAUSED)
-                    
-    def grab_frame(self, appsink):
-        sample = appsink.emit('pull-preroll')
-        if sample and self.seeked and not self.complete:
-            self.sample = sample
-            self.complete = True
-        
-        return Gst.FlowReturn.OK
+                fake.sync_state_with_parent()
 
-    def on_message(self, bus, msg):
-        if msg.type == Gst.MessageType.ERROR:
-            logging.error('GStreamer error for frame grabber: {}'.format(msg.parse_error()))
-            Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'framegrabber')
-        
-        elif msg.type == Gst.MessageType.WARNING:
-            logging.warning('GStreamer warning for frame grabber: {}'.format(msg.parse_error()))
+    async def seek(self, position, accurate = False, timeout = None):
+        '''Prerolls the pipeline at position, returning whether it could
 
-    async def grab(self):
-        self.pipeline.set_state(Gst.State.PAUSED)
-        
-        while not self.complete:
-            if not self.seeked:
-                res, state, pending = self.pipeline.get_state(10)
-                if res == Gst.StateChangeReturn.SUCCESS and state == Gst.State.PAUSED:
-                    self.pipeline.seek_simple(Gst.Format.TIME,
-                        Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, self.targettime)
-
-                    self.seeked = True
+        Raises asyncio.TimeoutError if it takes longer than timeout seconds,
+        after which the pipeline may still be prerolling.'''
+        # Don't seek if the pipeline is already there, like the first prerolled frame at 0
+        if position == self.prerolled:
+            return True
+        
+        flags = Gst.SeekFlags.FLUSH | (Gst.SeekFlags.ACCURATE if accurate else Gst.SeekFlags.KEY_UNIT)
+        self.prerolled = None
+        
+        done = await asyncio.wait_for(self.watcher.seek(position, flags), timeout)
+        if done and accurate:
+            self.prerolled = position
         
-            await asyncio.sleep(0.25)
+        return done
+    
+    async def grab_candidates(self):
+        start = time.monotonic()
+        best = None
         
-        Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'framegrabber')
-        self.pipeline.set_state(Gst.State.NULL)
+        for i, position in enumerate(self.positions):
+            # The first candidate is the poster if nothing better turns up, so only the stage's deadline bounds it
+            remaining = None
+            if i and self.budget:
+                remaining = self.budget - (time.monotonic() - start)
+                if remaining <= 0:
+                    logging.info('Poster frame budget used up after {} candidates'.format(i))
+                    break
+            
+            try:
+                if not await self.seek(position, timeout = remaining):
+                    continue
+            except asyncio.TimeoutError:
+                logging.info('Poster frame budget used up waiting for candidate {}'.format(i + 1))
+                break
+            
+            sample = self.appsink.emit('pull-preroll')
+            if not self.scaledsink:
+                self.sample = sample
+                break
+            
+            score = score_frame(sample_luma(self.scaledsink.emit('pull-preroll')))
+            self.scores.append((position, score))
+            
+            if sample and (best == None or score > best):
+                best = score
+                self.sample = sample
+    
+    async def grab_hashes(self):
+        start = time.monotonic()
+        
+        for i, position in enumerate(self.hash_positions):
+            # Accurate seeks decode from the keyframe before, so together they get one budget like the candidates
+            remaining = None
+            if self.budget:
+                remaining = self.budget - (time.monotonic() - start)
+                if remaining <= 0:
+                    logging.info('Frame hashing budget used up after {} frames'.format(i))
+                    break
+            
+            try:
+                if not await self.seek(position, accurate = True, timeout = remaining):
+                    continue
+            except asyncio.TimeoutError:
+                logging.info('Frame hashing budget used up seeking to {:.1f}s'.format(position / Gst.SECOND))
+                break
+            
+            self.hashes.append(phash(sample_luma(self.scaledsink.emit('pull-preroll'))))
+    
+    async def grab(self):
+        try:
+            if await self.watcher.set_state(Gst.State.PAUSED) and self.appsink:
+                await self.grab_candidates()
+                
+                # Hashed at their own positions, so they don't depend on how the poster was chosen
+                await self.grab_hashes()
+        finally:
+            self.watcher.stop()
         
         return self.sample
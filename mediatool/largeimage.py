@@ -0,0 +1,137 @@
+import io
+import logging
+import threading
+
+import asyncio
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .convert import output_size
+from .encode import save_image
+from .grabber import SCORE_WIDTH
+from .fingerprint import phash
+
+# Bytes per pixel of a decoded, color-converted frame
+FRAME_BYTES_PER_PIXEL = 4
+
+# Held while Pillow's decompression bomb limit is lifted, so it's only ever lifted for open_image
+bomb_check_lock = threading.Lock()
+
+def exceeds_limit(width, height, memory_limit):
+    '''Whether decoding a width x height image at full resolution would go over memory_limit bytes'''
+    return bool(width and height and memory_limit) and width * height * FRAME_BYTES_PER_PIXEL > memory_limit
+
+def should_reduce(format, width, height, memory_limit, max_width):
+    '''Whether a still should be converted by LargeImageConverter rather than decoded in full by GStreamer
+
+    Stills over memory_limit always are. JPEGs wider than max_width, the
+    widest output, are too when Pillow is available, as DCT scaling decodes
+    them at a fraction of the memory and time.'''
+    if exceeds_limit(width, height, memory_limit):
+        return True
+
+    return bool(Image) and format == 'image/jpeg' and bool(width) and width > max_width
+
+def sample_data(sample):
+    buf = sample.get_buffer()
+    return buf.extract_dup(0, buf.get_size())
+
+def open_image(source):
+    '''Opens an image given a path or bytes, reading only its header
+
+    Pillow refuses to open images of more than about 179 megapixels, as a
+    guard against decompression bombs. Callers bound memory themselves by
+    decoding at reduced resolution and checking exceeds_limit, so the guard
+    is lifted while this image is opened, and only then.'''
+    with bomb_check_lock:
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+
+        try:
+            return Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_pixels
+
+def image_size(source):
+    '''Reads an image's dimensions from its header, given a path or bytes, or returns None'''
+    if not Image:
+        return None
+
+    try:
+        with open_image(source) as image:
+            return image.size
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+class LargeImageConverter:
+    '''Converts a huge still image to image files without decoding it at full resolution
+
+    JPEGs are decoded with DCT scaling straight to the smallest size that's
+    still at least as large as the biggest output, then resized with Lanczos.
+    Formats that can't be decoded at reduced resolution are only converted if
+    they fit within memory_limit at full size. Outputs take the same options
+    as FrameConverter's, and a description of each file written is kept in
+    variants. With fingerprint set, a perceptual hash of the image is kept
+    in hash. Requires Pillow.'''
+    def __init__(self, source, outputs, memory_limit, fingerprint = False):
+        # A path to the image file, or its contents
+        self.source = source
+        self.outputs = outputs
+        self.memory_limit = memory_limit
+        self.variants = []
+
+        if fingerprint and not np:
+            logging.warning('NumPy is unavailable, so the image cannot be hashed')
+            fingerprint = False
+
+        self.fingerprint = fingerprint
+        self.hash = None
+
+    def convert_sync(self):
+        if not Image:
+            logging.warning('Pillow is unavailable, so large images cannot be converted')
+            return False
+
+        try:
+            return self.convert_image()
+        except (OSError, ValueError, SyntaxError) as e:
+            # Truncated or corrupt files, or formats Pillow can't read
+            logging.error('Could not convert large image: {}'.format(e))
+            return False
+
+    def convert_image(self):
+        with open_image(self.source) as image:
+            srcwidth, srcheight = image.size
+            sizes = [output_size(output, srcwidth, srcheight) for output in self.outputs]
+
+            image.draft('RGB', (max(w for w, h in sizes), max(h for w, h in sizes)))
+
+            width, height = image.size
+            if exceeds_limit(width, height, self.memory_limit):
+                logging.warning('Decoding {}x{} {} image would exceed the memory limit of {} bytes'.format(
+                    width, height, image.format, self.memory_limit))
+                return False
+
+            logging.info('Decoding {}x{} image at {}x{}'.format(srcwidth, srcheight, width, height))
+            image = image.convert('RGB')
+
+        if self.fingerprint:
+            # Scaled like the frames FrameGrabber hashes, so a still hashes the same however it was decoded
+            luma = image.convert('L').resize((SCORE_WIDTH, max(1, round(height * SCORE_WIDTH / width))), Image.BILINEAR)
+            self.hash = phash(np.asarray(luma))
+
+        for output, size in zip(self.outputs, sizes):
+            self.variants.append(save_image(image.resize(size, Image.LANCZOS), output))
+
+        return True
+
+    async def convert(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.convert_sync)
@@ -0,0 +1,91 @@
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def tap_branch(name, rate = None):
+    '''Describes a branch taking mono 16-bit audio to an appsink called name, resampled to rate if given
+
+    It's added to a pipeline description after a tee named tee carrying
+    decoded audio.'''
+    return 'tee. ! queue ! audioconvert ! {}audio/x-raw,format=S16LE,channels=1,{}layout=interleaved ! ' \
+           'appsink name={} sync=false emit-signals=true'.format(
+        'audioresample ! ' if rate else '', 'rate={},'.format(rate) if rate else '', name)
+
+class PCMTap:
+    '''Base for reducing the audio from a tap_branch appsink, a fixed number of samples at a time
+
+    Connect new_sample to the appsink's new-sample signal. Subclasses set
+    block_size, or set it from the sample rate in set_rate, and implement
+    add_blocks, which is given a 2D array of whole blocks of samples and
+    appends what it makes of them to chunks. Samples that don't yet make up
+    a whole block are kept in pending. Requires NumPy.'''
+    # Described in the warning logged when NumPy is unavailable
+    what = 'audio'
+
+    block_size = None
+
+    def __init__(self):
+        self.sample_rate = None
+        self.pending = np.zeros(0, np.int16)
+        self.chunks = []
+
+    @classmethod
+    def create(cls, enabled, *args):
+        '''Returns a new tap, or None if it's turned off or NumPy is unavailable'''
+        if not enabled:
+            return None
+
+        if not np:
+            logging.warning('NumPy is unavailable, so {} cannot be computed'.format(cls.what))
+            return None
+
+        return cls(*args)
+
+    @classmethod
+    def merge(cls, taps):
+        '''Joins the taps of consecutive segments into one'''
+        merged = taps[0].empty()
+
+        for tap in taps:
+            if not merged.sample_rate and tap.sample_rate:
+                merged.set_rate(tap.sample_rate)
+            merged.chunks += tap.chunks
+
+        return merged
+
+    def empty(self):
+        return type(self)()
+
+    def set_rate(self, rate):
+        self.sample_rate = rate
+
+    def new_sample(self, appsink):
+        sample = appsink.emit('pull-sample')
+
+        if sample:
+            if not self.sample_rate:
+                self.set_rate(sample.get_caps().get_structure(0).get_value('rate'))
+
+            buf = sample.get_buffer()
+            self.add(np.frombuffer(buf.extract_dup(0, buf.get_size()), np.int16))
+
+        return Gst.FlowReturn.OK
+
+    def add(self, samples):
+        samples = np.concatenate((self.pending, samples))
+        count = len(samples) // self.block_size
+
+        if count:
+            self.add_blocks(samples[:count * self.block_size].reshape(count, self.block_size))
+
+        self.pending = samples[count * self.block_size:]
+
+    def add_blocks(self, blocks):
+        raise NotImplementedError
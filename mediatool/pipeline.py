@@ -0,0 +1,143 @@
+import logging
+import asyncio
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .timing import current_span
+from .spool import current_spool
+
+class PipelineWatcher:
+    '''Watches a pipeline's bus and resolves asyncio futures as GStreamer reports progress'''
+    def __init__(self, pipeline, name, description):
+        self.pipeline = pipeline
+        self.name = name
+        self.description = description
+
+        self.loop = asyncio.get_event_loop()
+        self.error = None
+
+        # Every pending future, so an error can release anything waiting on this pipeline
+        self.futures = []
+        self.state_waiters = []
+        self.async_done_waiters = []
+
+        self.eos = self.create_future()
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect('message', self.on_message)
+
+    def create_future(self):
+        future = self.loop.create_future()
+
+        if self.error:
+            future.set_result(False)
+        else:
+            self.futures.append(future)
+
+        return future
+
+    def resolve(self, future, result):
+        if not future.done():
+            future.set_result(result)
+
+    def resolve_threadsafe(self, future, result):
+        # For use from GStreamer streaming threads, e.g. pad-added and appsink callbacks
+        self.loop.call_soon_threadsafe(self.resolve, future, result)
+
+    def fail(self, error):
+        self.error = error
+
+        for future in self.futures:
+            self.resolve(future, False)
+
+        self.futures = []
+        self.state_waiters = []
+        self.async_done_waiters = []
+
+    def on_message(self, bus, msg):
+        if msg.type == Gst.MessageType.ERROR:
+            logging.error('GStreamer error for {}: {}'.format(self.description, msg.parse_error()))
+            Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, self.name)
+            self.fail(msg.parse_error())
+
+        elif msg.type == Gst.MessageType.WARNING:
+            logging.warning('GStreamer warning for {}: {}'.format(self.description, msg.parse_warning()))
+
+        elif msg.type == Gst.MessageType.EOS:
+            self.resolve(self.eos, True)
+
+        elif msg.type == Gst.MessageType.STATE_CHANGED and msg.src == self.pipeline:
+            old, new, pending = msg.parse_state_changed()
+
+            for state, future in self.state_waiters:
+                if state == new: self.resolve(future, True)
+
+            self.state_waiters = [(s, f) for s, f in self.state_waiters if not f.done()]
+
+        elif msg.type == Gst.MessageType.ASYNC_DONE and msg.src == self.pipeline:
+            for future in self.async_done_waiters:
+                self.resolve(future, True)
+
+            self.async_done_waiters = []
+
+    async def set_state(self, state):
+        '''Changes the pipeline's state, returning True once it's reached or False on error'''
+        future = self.create_future()
+        self.state_waiters.append((state, future))
+
+        res = self.pipeline.set_state(state)
+        if res == Gst.StateChangeReturn.FAILURE:
+            self.fail('Failed to change {} to state {}'.format(self.description, state))
+        elif res == Gst.StateChangeReturn.SUCCESS or res == Gst.StateChangeReturn.NO_PREROLL:
+            self.resolve(future, True)
+
+        return await future
+
+    async def seek(self, position, flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, stop = None):
+        '''Performs a flushing seek, returning True once the pipeline has prerolled at the new position'''
+        future = self.create_future()
+        self.async_done_waiters.append(future)
+
+        if stop == None:
+            res = self.pipeline.seek_simple(Gst.Format.TIME, flags, int(position))
+        else:
+            res = self.pipeline.seek(1.0, Gst.Format.TIME, flags, Gst.SeekType.SET, int(position),
+                                     Gst.SeekType.SET, int(stop))
+
+        if not res:
+            logging.warning('Seek failed for {}'.format(self.description))
+            self.resolve(future, False)
+
+        return await future
+
+    async def run(self):
+        '''Plays the pipeline, returning True on EOS or False on error'''
+        if self.pipeline.get_state(0)[1] != Gst.State.PLAYING and \
+           self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            self.fail('Failed to start {}'.format(self.description))
+
+        return await self.eos
+
+    def stop(self):
+        Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, self.name)
+
+        # Report the latency to the stage this pipeline ran in, while it can still be queried
+        span = current_span.get()
+        if span and not self.error:
+            query = Gst.Query.new_latency()
+            if self.pipeline.query(query):
+                span.add_latency(self.name, *query.parse_latency())
+
+        self.pipeline.set_state(Gst.State.NULL)
+        self.bus.remove_signal_watch()
+
+        # A reader left held on a read would otherwise keep pausing every later stage's deadline
+        spool = current_spool.get()
+        if spool:
+            spool.detach(self.pipeline)
+
+        for future in self.futures:
+            self.resolve(future, False)
@@ -0,0 +1,67 @@
+import logging
+
+# Elements every job may need, and the plugin set each is found in
+REQUIRED_ELEMENTS = {
+    'rganalysis': 'gst-plugins-good',
+    'bpmdetect': 'gst-plugins-bad',
+    'jpegenc': 'gst-plugins-good',
+    'uridecodebin': 'gst-plugins-base',
+    'decodebin': 'gst-plugins-base',
+    'appsrc': 'gst-plugins-base',
+    'appsink': 'gst-plugins-base',
+    'audioconvert': 'gst-plugins-base',
+    'audioresample': 'gst-plugins-base',
+    'videoconvert': 'gst-plugins-base',
+    'videoscale': 'gst-plugins-base',
+    'tee': 'gstreamer',
+    'queue': 'gstreamer',
+    'fakesink': 'gstreamer',
+    'filesink': 'gstreamer',
+}
+
+# Only needed when transcoding, besides one of transcoder.AAC_ENCODERS for renditions to have audio
+TRANSCODE_ELEMENTS = {
+    'x264enc': 'gst-plugins-ugly',
+    'h264parse': 'gst-plugins-bad',
+    'mp4mux': 'gst-plugins-good',
+    'aacparse': 'gst-plugins-good',
+}
+
+_initialized = False
+
+def init_gst():
+    '''Loads GStreamer and initializes it, once per process
+
+    This is the slow part of starting up, as it reads the GObject
+    introspection typelibs and the plugin registry, so it waits until
+    something is about to build a pipeline rather than happening on import.'''
+    global _initialized
+    if _initialized:
+        return
+
+    import gi
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstPbutils', '1.0')
+    from gi.repository import Gst, GstPbutils
+
+    Gst.init(None)
+    GstPbutils.pb_utils_init()
+
+    _initialized = True
+
+def missing_elements(transcode = False):
+    '''Returns the names of the required elements that aren't installed, with the plugin set providing each'''
+    init_gst()
+    from gi.repository import Gst
+
+    required = dict(REQUIRED_ELEMENTS, **(TRANSCODE_ELEMENTS if transcode else {}))
+    return {name: plugins for name, plugins in required.items() if not Gst.ElementFactory.find(name)}
+
+def check(transcode = False):
+    '''Logs an error for every missing element, returning whether all of them are installed'''
+    missing = missing_elements(transcode)
+
+    for name, plugins in sorted(missing.items()):
+        logging.error('The {} element is missing, install {} to provide it'.format(name, plugins))
+
+    return not missing
@@ -0,0 +1,159 @@
+import os
+import math
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .pipeline import PipelineWatcher
+from .engine import find_decoder
+from .convert import FrameConverter
+
+def vtt_time(ns):
+    ms = int(ns // Gst.MSECOND)
+    return '{:02}:{:02}:{:02}.{:03}'.format(ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+def write_vtt(path, sprite_name, cues):
+    '''Writes a WebVTT file of (start, end, x, y, width, height) cues pointing into the sprite sheet'''
+    with open(path, 'w') as fd:
+        fd.write('WEBVTT\n')
+
+        for start, end, x, y, w, h in cues:
+            fd.write('\n{} --> {}\n{}#xywh={},{},{},{}\n'.format(vtt_time(start), vtt_time(end), sprite_name, x, y, w, h))
+
+def rename_sprite(vtt_path, sprite_name):
+    '''Points an existing WebVTT file's cues at a sprite sheet with a different file name'''
+    with open(vtt_path) as fd:
+        lines = fd.read().split('\n')
+
+    lines = [sprite_name + line[line.index('#xywh='):] if '#xywh=' in line else line for line in lines]
+
+    # The file may be hard linked from the result cache, so replace it rather than writing to it
+    os.unlink(vtt_path)
+    with open(vtt_path, 'w') as fd:
+        fd.write('\n'.join(lines))
+
+class PreviewGenerator:
+    '''Makes a sprite sheet of evenly spaced thumbnails and a WebVTT index of it, for scrubbing previews
+
+    Each tile comes from a key unit seek, with the decoder only ever fed
+    keyframes, so the decoding work is the same however long the video is.
+    Frames are scaled down to tile size in the pipeline. Requires NumPy.'''
+    def __init__(self, uri, track, duration, sprite_path, vtt_path, count = 25, columns = 5, tile_width = 160,
+                 source_setup = None):
+        self.track = track
+        self.duration = duration
+        self.sprite_path = sprite_path
+        self.vtt_path = vtt_path
+        self.count = count
+        self.columns = columns
+
+        self.tile_width = tile_width
+        ratio = track['width'] / track['height'] if track.get('width') and track.get('height') else 16 / 9
+        self.tile_height = int(round(tile_width / ratio / 2)) * 2
+
+        self.appsink = None
+
+        self.pipeline = Gst.Pipeline.new()
+        self.watcher = PipelineWatcher(self.pipeline, 'preview', 'preview generator {}'.format(uri))
+
+        self.decodebin = Gst.ElementFactory.make('uridecodebin')
+        self.decodebin.set_property('uri', uri)
+        self.decodebin.connect('pad-added', self.pad_added)
+        if source_setup: self.decodebin.connect('source-setup', source_setup)
+
+        self.pipeline.add(self.decodebin)
+
+    def pad_added(self, decodebin, pad):
+        caps = pad.get_current_caps()
+        if not caps: return
+
+        decoder = find_decoder(pad)
+
+        if not self.appsink and pad.get_stream_id() == self.track.get('stream-id', pad.get_stream_id()) and \
+           caps.get_structure(0).get_name().startswith('video/'):
+            branch = Gst.parse_bin_from_description(
+                'videoconvert ! videoscale ! video/x-raw,format=RGBx,width={},height={},pixel-aspect-ratio=1/1 ! '
+                'appsink name=sink drop=true'.format(self.tile_width, self.tile_height), True)
+            self.appsink = branch.get_by_name('sink')
+
+            # Every seek lands on a keyframe, so whatever follows it never needs decoding
+            if decoder:
+                decoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+                    lambda pad, info: Gst.PadProbeReturn.DROP if info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT)
+                                      else Gst.PadProbeReturn.OK)
+
+        else:
+            branch = Gst.ElementFactory.make('fakesink')
+
+            if decoder:
+                decoder.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER,
+                    lambda pad, info: Gst.PadProbeReturn.DROP)
+
+        self.pipeline.add(branch)
+        pad.link(branch.get_static_pad('sink'))
+        branch.sync_state_with_parent()
+
+    def tile(self, sample):
+        buf = sample.get_buffer()
+        data = buf.extract_dup(0, buf.get_size())
+
+        rows = np.frombuffer(data, np.uint8).reshape(self.tile_height, len(data) // self.tile_height)
+        return rows[:, :self.tile_width * 4].reshape(self.tile_height, self.tile_width, 4)
+
+    async def generate(self):
+        '''Writes the sprite sheet and WebVTT file, returning whether it succeeded'''
+        if not np:
+            logging.warning('NumPy is unavailable, so preview sprites cannot be generated')
+            return False
+
+        if not self.duration:
+            return False
+
+        rows = math.ceil(self.count / self.columns)
+        sprite = np.zeros((rows * self.tile_height, self.columns * self.tile_width, 4), np.uint8)
+        cues = []
+        tile = None
+
+        try:
+            if not (await self.watcher.set_state(Gst.State.PAUSED) and self.appsink):
+                return False
+
+            for i in range(self.count):
+                start = self.duration * i // self.count
+                end = self.duration * (i + 1) // self.count
+
+                # Seek to the middle of the tile's interval, so the keyframe before it likely falls inside it
+                if await self.watcher.seek((start + end) // 2):
+                    sample = self.appsink.emit('pull-preroll')
+                    if sample: tile = self.tile(sample)
+
+                x = i % self.columns * self.tile_width
+                y = i // self.columns * self.tile_height
+
+                # Repeat the previous tile if a seek fails, rather than leaving a hole
+                if tile is not None:
+                    sprite[y:y + self.tile_height, x:x + self.tile_width] = tile
+
+                cues.append((start, end, x, y, self.tile_width, self.tile_height))
+        finally:
+            self.watcher.stop()
+
+        if tile is None:
+            return False
+
+        height, width = sprite.shape[:2]
+        caps = Gst.Caps.from_string('video/x-raw,format=RGBx,width={},height={},framerate=0/1'.format(width, height))
+        sample = Gst.Sample.new(Gst.Buffer.new_wrapped(sprite.tobytes()), caps, None, None)
+
+        if not await FrameConverter(sample, [{'path': self.sprite_path, 'quality': 75}]).convert():
+            return False
+
+        write_vtt(self.vtt_path, os.path.basename(self.sprite_path), cues)
+        return True
@@ -0,0 +1,151 @@
+import os
+import shutil
+import logging
+import tempfile
+
+import asyncio
+
+NANOSECONDS = 10**9
+
+# Seconds each stage is allowed, as a fixed allowance plus multiples of the media's duration in
+# seconds and its size in MB. The stages that find the duration can only be scaled by size. A stage
+# whose deadline depends on a duration or size that isn't known has none, as do stages that aren't
+# listed, like downloading.
+DEADLINES = {
+    'probe': (30, 0, 0.05),
+    'tracks': (60, 0, 0.1),
+    'single_pass': (60, 0, 1),
+    'audio': (60, 0.5, 0),
+    'poster_grab': (60, 0, 0),
+    'poster_convert': (60, 0, 0),
+    'preview': (120, 0, 0),
+    'transcode': (300, 4, 0),
+}
+
+# Stages a job can finish without, reported as skipped if they run out of time
+OPTIONAL_STAGES = {'audio', 'poster_grab', 'poster_convert', 'preview', 'transcode'}
+
+class StageTimeout(Exception):
+    pass
+
+def available_memory():
+    try:
+        with open('/proc/meminfo') as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+class Scheduler:
+    '''Admits jobs while there's CPU, memory and temporary disk space to spare, and sets deadlines for their stages
+
+    A job is held back while free memory or disk space is below min_memory or
+    min_disk bytes, unless no other job is running. Jobs admitted while the
+    load average per CPU is over max_load, or while memory is below twice the
+    minimum, are degraded and skip their optional work. Stage deadlines are
+    scaled by deadline_scale, and 0 turns them off.'''
+    def __init__(self, max_load = 1.0, min_memory = 512 * 2**20, min_disk = 2**30, deadline_scale = 1.0,
+                 poll_interval = 1):
+        self.max_load = max_load
+        self.min_memory = min_memory
+        self.min_disk = min_disk
+        self.deadline_scale = deadline_scale
+        self.poll_interval = poll_interval
+
+        self.running = 0
+
+    def shortages(self):
+        '''Lists the resources too scarce to start another job'''
+        short = []
+
+        memory = available_memory()
+        if memory != None and memory < self.min_memory:
+            short.append('memory')
+
+        if shutil.disk_usage(tempfile.gettempdir()).free < self.min_disk:
+            short.append('disk')
+
+        return short
+
+    def overloaded(self):
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            load = 0
+
+        memory = available_memory()
+        return load > self.max_load or (memory != None and memory < self.min_memory * 2)
+
+    async def admit(self):
+        '''Waits until a job can start, returning whether it should skip optional work'''
+        waiting = False
+
+        while self.running:
+            short = self.shortages()
+            if not short:
+                break
+
+            if not waiting:
+                logging.warning('Holding jobs until there is more free {}'.format(' and '.join(short)))
+                waiting = True
+
+            await asyncio.sleep(self.poll_interval)
+
+        self.running += 1
+
+        degraded = self.overloaded()
+        if degraded:
+            logging.warning('Admitting job while overloaded, it will skip optional stages')
+
+        return degraded
+
+    def release(self):
+        self.running -= 1
+
+    def deadline(self, stage, duration, size = None):
+        '''Seconds stage may take for media of duration nanoseconds and size bytes, or None for no deadline'''
+        if not self.deadline_scale or stage not in DEADLINES:
+            return None
+
+        fixed, per_second, per_mb = DEADLINES[stage]
+        if (per_second and duration == None) or (per_mb and size == None):
+            return None
+
+        return (fixed + per_second * (duration or 0) / NANOSECONDS + per_mb * (size or 0) / 2**20) * self.deadline_scale
+
+    async def run_stage(self, stage, duration, awaitable, size = None, waited = None):
+        '''Awaits a stage, cancelling it and raising StageTimeout once its deadline passes
+
+        If given, waited returns the seconds spent so far waiting on the
+        download, which don't count towards the deadline. Cancelling a stage
+        stops its pipelines, which set them to NULL on the way out.'''
+        timeout = self.deadline(stage, duration, size)
+        if timeout == None:
+            return await awaitable
+
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(awaitable)
+
+        started = loop.time()
+        waited_before = waited() if waited else 0
+
+        try:
+            while True:
+                elapsed = loop.time() - started - ((waited() - waited_before) if waited else 0)
+                if elapsed >= timeout:
+                    raise StageTimeout('The {} stage took longer than its deadline of {:.0f}s'.format(stage, timeout))
+
+                # Checked again once the remaining time is up, in case some of it went on waiting
+                done, pending = await asyncio.wait([task], timeout = timeout - elapsed)
+                if done:
+                    return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait([task])
@@ -0,0 +1,170 @@
+import os
+import time
+import threading
+import contextvars
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstApp', '1.0')
+from gi.repository import Gst, GstApp
+
+SPOOL_URI = 'appsrc://'
+
+# The spool the current task's pipelines read from, for them to detach from when they stop
+current_spool = contextvars.ContextVar('current_spool', default = None)
+
+class SpoolFile:
+    '''A file that's still being downloaded, readable by pipelines while it fills up
+
+    Pipelines read it through uridecodebin or urisourcebin with SPOOL_URI,
+    connecting source_setup to their source-setup signal. Reads past what has
+    been downloaded so far are held until the data arrives.'''
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+
+        self.available = 0
+        self.complete = False
+
+        self.lock = threading.Lock()
+        self.readers = []
+
+        # Readers held until more has downloaded, and how long at least one has been held for in total
+        self.waiting = set()
+        self.wait_started = None
+        self.wait_total = 0
+
+    def set_waiting(self, reader, waiting):
+        with self.lock:
+            if waiting:
+                self.waiting.add(reader)
+            else:
+                self.waiting.discard(reader)
+
+            now = time.monotonic()
+            if self.waiting and self.wait_started == None:
+                self.wait_started = now
+            elif not self.waiting and not self.wait_started == None:
+                self.wait_total += now - self.wait_started
+                self.wait_started = None
+
+    def waited(self):
+        '''Seconds pipelines have spent waiting on the download so far, including any wait in progress'''
+        with self.lock:
+            if self.wait_started == None:
+                return self.wait_total
+
+            return self.wait_total + time.monotonic() - self.wait_started
+
+    def written(self, available):
+        '''Called as the download progresses, with the number of bytes on disk from the start of the file'''
+        with self.lock:
+            self.available = available
+            readers = list(self.readers)
+
+        for reader in readers:
+            reader.service()
+
+    def finish(self):
+        '''Called when the download has ended, successfully or not'''
+        with self.lock:
+            self.complete = True
+            readers = list(self.readers)
+
+        for reader in readers:
+            reader.service()
+
+    def close(self):
+        with self.lock:
+            readers = self.readers
+            self.readers = []
+
+        for reader in readers:
+            reader.close()
+
+    def detach(self, pipeline):
+        '''Closes the readers of a pipeline that has stopped, so they aren't counted as waiting any more'''
+        with self.lock:
+            readers = [reader for reader in self.readers if reader.appsrc.has_as_ancestor(pipeline)]
+            self.readers = [reader for reader in self.readers if reader not in readers]
+
+        for reader in readers:
+            reader.close()
+
+    def source_setup(self, decodebin, source):
+        with self.lock:
+            self.readers.append(SpoolReader(self, source))
+
+class SpoolReader:
+    '''Feeds one pipeline's appsrc from a SpoolFile, in random-access mode so demuxers can seek'''
+    def __init__(self, spool, appsrc):
+        self.spool = spool
+        self.appsrc = appsrc
+
+        self.fd = os.open(spool.filename, os.O_RDONLY)
+        self.offset = 0
+        self.wanted = None
+
+        self.lock = threading.Lock()
+
+        appsrc.set_property('stream-type', GstApp.AppStreamType.RANDOM_ACCESS)
+        appsrc.set_property('format', Gst.Format.BYTES)
+        appsrc.set_property('size', spool.size)
+
+        appsrc.connect('need-data', self.need_data)
+        appsrc.connect('seek-data', self.seek_data)
+
+    def seek_data(self, appsrc, offset):
+        with self.lock:
+            self.offset = offset
+            self.wanted = None
+
+        self.spool.set_waiting(self, False)
+        return True
+
+    def need_data(self, appsrc, length):
+        with self.lock:
+            self.wanted = length
+
+        self.service()
+
+    def service(self):
+        with self.lock:
+            if self.wanted == None or self.fd == None:
+                return
+
+            end = min(self.offset + self.wanted, self.spool.size)
+            held = False
+
+            if self.offset >= end:
+                data = None
+            elif self.spool.available >= end:
+                data = os.pread(self.fd, end - self.offset, self.offset)
+            elif self.spool.complete:
+                # The download ended early, so hand over whatever made it to disk
+                data = os.pread(self.fd, max(self.spool.available - self.offset, 0), self.offset) or None
+            else:
+                # Demuxers take a short read to mean the end of the file, so wait for the whole range
+                held = True
+
+            if not held:
+                self.wanted = None
+                if data: self.offset += len(data)
+
+        # Stage deadlines don't count the time spent held here
+        self.spool.set_waiting(self, held)
+        if held:
+            return
+
+        if data:
+            self.appsrc.push_buffer(Gst.Buffer.new_wrapped(data))
+        else:
+            self.appsrc.end_of_stream()
+
+    def close(self):
+        with self.lock:
+            if not self.fd == None:
+                os.close(self.fd)
+                self.fd = None
+
+        self.spool.set_waiting(self, False)
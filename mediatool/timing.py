@@ -0,0 +1,98 @@
+import sys
+import time
+import resource
+import contextlib
+import contextvars
+
+# The span of the stage running in the current task, for pipelines to report their latency to
+current_span = contextvars.ContextVar('current_span', default = None)
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peak_rss():
+    # Reported in kilobytes on Linux, but bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def bytes_read():
+    '''Bytes the process has read through system calls, from files and sockets alike, or None if unknown'''
+    try:
+        with open('/proc/self/io') as fd:
+            for line in fd:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+class Span:
+    '''Measures one stage from its creation until finish is called
+
+    CPU time, bytes read and peak RSS are process-wide, so stages that run
+    concurrently, or jobs sharing a worker, are each charged for the others'
+    work while they overlap.'''
+    def __init__(self, name):
+        self.name = name
+
+        # Pipeline name to its latency in nanoseconds, as reported by a latency query
+        self.latency = {}
+
+        self.wall = time.monotonic()
+        self.cpu = cpu_time()
+        self.read = bytes_read()
+
+    def add_latency(self, pipeline, live, min_latency, max_latency):
+        self.latency[pipeline] = {
+            'live': live,
+            'min': min_latency,
+            'max': max_latency if max_latency < 2**64 - 1 else None,
+        }
+
+    def finish(self):
+        read = bytes_read()
+
+        return {
+            'stage': self.name,
+            'wall': round(time.monotonic() - self.wall, 3),
+            'cpu': round(cpu_time() - self.cpu, 3),
+            'bytes_read': read - self.read if not (read == None or self.read == None) else None,
+            'peak_rss': peak_rss(),
+            'latency': self.latency,
+        }
+
+class StageTimer:
+    '''Times a job's stages, emitting an event as each one finishes
+
+    When disabled, stages run untimed and nothing is emitted.'''
+    def __init__(self, emit, enabled = True):
+        self.emit = emit
+        self.enabled = enabled
+
+        self.start = time.monotonic()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield None
+            return
+
+        span = Span(name)
+        token = current_span.set(span)
+
+        try:
+            yield span
+        finally:
+            current_span.reset(token)
+
+            event = span.finish()
+            self.stages.append(event)
+            self.emit({'timing': event})
+
+    def summary(self):
+        return {
+            'wall': round(time.monotonic() - self.start, 3),
+            'peak_rss': peak_rss(),
+            'stages': self.stages,
+        }
@@ -1,139 +1,205 @@
 import logging
-import asyncio
 
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst
-
-Gst.init(None)
+gi.require_version('GstPbutils', '1.0')
+from gi.repository import Gst, GstPbutils
 
+from .pipeline import PipelineWatcher
 from .taglist_utils import create_taglist_getters
 
+def parse_metadata(tag_list):
+    '''Extracts the metadata fields we care about from a Gst.TagList'''
+    gs, gu, gd = create_taglist_getters(tag_list)
+    
+    metadata = {
+        'album': gs(Gst.TAG_ALBUM),
+        'artist': gs(Gst.TAG_ARTIST),
+        'composer': gs(Gst.TAG_COMPOSER),
+        'genre': gs(Gst.TAG_GENRE),
+        'license': gs(Gst.TAG_LICENSE),
+        'performer': gs(Gst.TAG_PERFORMER),
+        'title': gs(Gst.TAG_TITLE),
+        'track-number': gu(Gst.TAG_TRACK_NUMBER),
+        'channel-mode': gs('channel-mode'),
+        'replaygain': gd(Gst.TAG_TRACK_GAIN),
+    }
+    
+    bpm = gd(Gst.TAG_BEATS_PER_MINUTE)
+    if bpm: metadata['bpm'] = round(bpm, 1)
+    
+    return {k: v for k, v in metadata.items() if not v == None}
+
+def track_from_caps(caps):
+    '''Describes a track from its caps, which may be decoded or straight from a parser'''
+    struct = caps.get_structure(0)
+    logging.debug('Track found with caps: {}'.format(struct.to_string()))
+    
+    track = {'caps': caps}
+
+    name = struct.get_name()
+    _type = name.split('/')[0]
+    
+    if not name.endswith('/x-raw'):
+        track['codec'] = GstPbutils.pb_utils_get_codec_description(caps)
+        track['codec-caps'] = caps.to_string()
+    
+    if _type == 'audio':
+        track['type'] = 'audio'
+        track['samplerate'] = struct.get_value('rate')
+        track['channels'] = struct.get_value('channels')
+    
+    elif _type == 'video' or _type == 'image':
+        track['width'] = struct.get_value('width')
+        track['height'] = struct.get_value('height')
+        
+        found, numerator, denominator = struct.get_fraction('framerate')
+        if _type == 'image' or (found and numerator == 0): # Framerate of 0 means track is a still image
+            track['type'] = 'image'
+        else:
+            track['type'] = 'video'
+            if found: track['framerate'] = round(numerator / float(denominator), 2)
+        
+    else:
+        track['type'] = 'invalid'
+    
+    return track
+
+def update_track_from_tags(track, tag_list):
+    '''Adds per-stream details from a track's own tags'''
+    gs, gu, gd = create_taglist_getters(tag_list)
+    
+    bitrate = gu(Gst.TAG_BITRATE) or gu(Gst.TAG_NOMINAL_BITRATE)
+    if bitrate: track['bitrate'] = bitrate
+
+def stream_event(pad, info, track):
+    event = info.get_event()
+    
+    if event.type == Gst.EventType.TAG:
+        update_track_from_tags(track, event.parse_tag())
+    
+    return Gst.PadProbeReturn.OK
+
+def choose_poster_track(tracks):
+    '''Picks the video or image track best suited for grabbing a poster frame from'''
+    best = None
+    
+    # Overly-complex track-selection logic on the tiny chance it gets fed media files with multiple video and image tracks
+    for track in tracks:
+        if track['type'] == 'video':
+            if not best: best = track                        
+            elif best['type'] == 'image': best = track
+            elif best['type'] == 'video':
+                if track['width'] * track['height'] > best['width'] * best['height']:
+                    best = track
+        
+        elif track['type'] == 'image':
+            if not best: best = track                        
+            elif best['type'] == 'image' and track['width'] * track['height'] > \
+                                             best['width']  * best['height']:
+                best = track
+    
+    return best
+
 class TrackAndTagGetter:
-    def __init__(self, uri):
+    '''Finds a media file's tracks, duration and tags
+
+    In probe mode the file is only typefound and parsed, never decoded, so the
+    tracks describe the compressed streams as their container headers do.'''
+    def __init__(self, uri, probe = False, source_setup = None):
         self.uri = uri
+        self.probe = probe
+        
+        if self.probe and not (Gst.ElementFactory.find('urisourcebin') and Gst.ElementFactory.find('parsebin')):
+            logging.warning('parsebin is unavailable, decoding media to find its tracks instead')
+            self.probe = False
 
         self.tracks = []
         self.metadata = {}
         
-        self.tracks_done = False
         self.duration = None
         self.poster_sample = None
 
         self.pipeline = Gst.Pipeline.new()
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self.bus.connect('message', self.on_message)
+        self.watcher = PipelineWatcher(self.pipeline, 'analyze', 'media {}'.format(self.uri))
+        self.watcher.bus.connect('message', self.on_message)
+        
+        self.tracks_done = self.watcher.create_future()
+        
+        if self.probe:
+            self.source = Gst.ElementFactory.make('urisourcebin')
+            self.source.connect('pad-added', self.source_pad_added)
+            self.source.set_property('uri', self.uri)
+            
+            self.decodebin = Gst.ElementFactory.make('parsebin')
+            self.pipeline.add(self.source)
+        else:
+            self.decodebin = Gst.ElementFactory.make('uridecodebin')
+            self.decodebin.set_property('uri', self.uri)
         
-        self.decodebin = Gst.ElementFactory.make('uridecodebin')
         self.decodebin.connect('pad-added', self.pad_added)
         self.decodebin.connect('no-more-pads', self.no_more_pads)
-        self.decodebin.set_property('uri', self.uri)
+        
+        if source_setup:
+            (self.source if self.probe else self.decodebin).connect('source-setup', source_setup)
         
         self.pipeline.add(self.decodebin)
     
     async def go(self):
-        self.pipeline.set_state(Gst.State.PLAYING)
-        
-        # Use decodebin to determine the media container's contents and get any metadata
-        while self.duration == None or not self.tracks_done:
-            res, state, pending = self.pipeline.get_state(10)
-            if self.duration == None and res == Gst.StateChangeReturn.SUCCESS and \
-                   (state == Gst.State.PAUSED or state == Gst.State.PLAYING):               
-                res, duration = self.decodebin.query_duration(Gst.Format.TIME)
+        try:
+            # Use decodebin or parsebin to determine the media container's contents and get any metadata.
+            # Prerolling is enough to expose every track and answer the duration query.
+            if await self.watcher.set_state(Gst.State.PAUSED) and await self.tracks_done:
+                res, duration = self.pipeline.query_duration(Gst.Format.TIME)
                 if res:
                     logging.info('Media duration is {}'.format(duration))
                     self.duration = duration
                 else:
                     self.duration = 0
-            
-            await asyncio.sleep(0.25)
-        
-        self.pipeline.set_state(Gst.State.NULL)
+            else:
+                self.duration = 0
+                self.tracks = []
+        finally:
+            self.watcher.stop()
         
         return self.tracks, self.metadata, self.duration, self.poster_sample
     
     def on_message(self, bus, msg):
-        if msg.type == Gst.MessageType.ERROR:
-            Gst.debug_bin_to_dot_file(self.pipeline, Gst.DebugGraphDetails.ALL, 'analyze')
-            logging.error('GStreamer error for media {}: {}'.format(self.uri, msg.parse_error()))
-            self.duration = 0
-            self.tracks = []
-            self.tracks_done = True
-        
-        elif msg.type == Gst.MessageType.WARNING:
-            logging.warning('GStreamer warning for media {}: {}'.format(self.uri, msg.parse_error()))
-        
-        elif msg.type == Gst.MessageType.TAG:
+        if msg.type == Gst.MessageType.TAG:
             tag_list = msg.parse_tag()
             
-            gs, gu, gd = create_taglist_getters(tag_list)
-            
-            metadata = {
-                'album': gs(Gst.TAG_ALBUM),
-                'artist': gs(Gst.TAG_ARTIST),
-                'composer': gs(Gst.TAG_COMPOSER),
-                'genre': gs(Gst.TAG_GENRE),
-                'license': gs(Gst.TAG_LICENSE),
-                'performer': gs(Gst.TAG_PERFORMER),
-                'title': gs(Gst.TAG_TITLE),
-                'track-number': gu(Gst.TAG_TRACK_NUMBER),
-                'channel-mode': gs('channel-mode'),
-                'replaygain': gd(Gst.TAG_TRACK_GAIN),
-            }
-            
-            bpm = gd(Gst.TAG_BEATS_PER_MINUTE)
-            if bpm: metadata['bpm'] = round(bpm, 1)
-            
-            for k, v in metadata.items():
-                if not v == None: self.metadata[k] = v
+            self.metadata.update(parse_metadata(tag_list))
             
             if not self.poster_sample:
                 found, sample = tag_list.get_sample(Gst.TAG_IMAGE)
                 if found:
                     logging.info('Found poster image in file tag')
                     self.poster_sample = sample
-                
-        elif msg.type == Gst.MessageType.EOS:
-            self.analyzing = False
+    
+    def source_pad_added(self, source, pad):
+        sink = self.decodebin.get_static_pad('sink')
+        if not sink.is_linked():
+            pad.link(sink)
     
     def pad_added(self, decodebin, pad):
         caps = pad.get_current_caps()
         
         if caps:
-            struct = caps.get_structure(0)
-            logging.debug('Track found with caps: {}'.format(struct.to_string()))
-            
-            track = {'caps': caps}
             suffix = '_{}'.format(len(self.tracks))
-
-            name = struct.get_name()
-            _type = name.split('/')[0]
-            
-            if _type == 'audio':
-                track['type'] = 'audio'
-                track['samplerate'] = struct.get_value('rate')
-            
-            elif _type == 'video':
-                track['width'] = struct.get_value('width')
-                track['height'] = struct.get_value('height')
-                
-                found, numerator, denominator = struct.get_fraction('framerate')
-                if numerator == 0: # Framerate of 0 means track is a still image
-                    track['type'] = 'image'
-                else:
-                    track['type'] = 'video'
-                    track['framerate'] = round(numerator / float(denominator), 2)
-                
-            else:
-                track['type'] = 'invalid'
             
+            track = track_from_caps(caps)
+            track['stream-id'] = pad.get_stream_id()
             self.tracks.append(track)
             
+            # Tags that arrived before the pad was exposed are kept as sticky events
+            tags = pad.get_sticky_event(Gst.EventType.TAG, 0)
+            if tags: update_track_from_tags(track, tags.parse_tag())
+            pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, stream_event, track)
+            
             fake = Gst.ElementFactory.make('fakesink', 'fakesink' + suffix)
             self.pipeline.add(fake)
             pad.link(fake.get_static_pad('sink'))
-            fake.set_state(Gst.State.PLAYING)
+            fake.sync_state_with_parent()
     
     def no_more_pads(self, decodebin):
-        self.tracks_done = True
+        self.watcher.resolve_threadsafe(self.tracks_done, True)
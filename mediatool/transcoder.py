@@ -0,0 +1,124 @@
+import logging
+import asyncio
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .pipeline import PipelineWatcher
+
+# Heights and video bitrates in kbit/s of the default MP4 renditions
+DEFAULT_RENDITIONS = [
+    {'name': '1080p', 'height': 1080, 'bitrate': 5000},
+    {'name': '720p', 'height': 720, 'bitrate': 2800},
+    {'name': '480p', 'height': 480, 'bitrate': 1200},
+]
+
+# In order of preference, the first one installed is used
+AAC_ENCODERS = ['fdkaacenc', 'avenc_aac', 'voaacenc', 'faac']
+
+# x264 holds back frames for lookahead, so the muxers need room to queue the other streams meanwhile
+QUEUE = 'queue max-size-buffers=0 max-size-bytes=0 max-size-time={}'.format(10 * Gst.SECOND)
+
+def find_element(names):
+    for name in names:
+        if Gst.ElementFactory.find(name):
+            return name
+
+class Transcoder:
+    '''Transcodes a video to H.264/AAC MP4 renditions at several sizes from a single decode
+
+    The decoded video is teed to one scaler and x264 encoder per rendition,
+    and the audio is encoded once and teed into every muxer. Renditions are
+    dicts with a path, height and bitrate, and any taller than the source are
+    skipped. The MP4s are written with their index at the start, so they can
+    be streamed as soon as they're done. Only the video stream of track is
+    transcoded, matched by its stream ID, along with the first audio stream.'''
+    def __init__(self, uri, track, has_audio, duration, renditions, speed_preset = 'medium', threads = 0,
+                 audio_bitrate = 128, source_setup = None, on_progress = None):
+        self.duration = duration
+        self.on_progress = on_progress
+
+        self.stream_id = track.get('stream-id')
+
+        srcwidth, srcheight = track['width'], track['height']
+
+        self.renditions = [dict(r) for r in renditions if r['height'] <= srcheight] or \
+                          [dict(min(renditions, key = lambda r: r['height']), height = srcheight)]
+
+        # The decoder's pads are linked to videoin and audioin as they appear, so the right streams are picked
+        description = 'uridecodebin name=decodebin uri="{}" caps="video/x-raw;audio/x-raw" expose-all-streams=false ' \
+                      '{} name=videoin ! videoconvert ! tee name=video'.format(uri, QUEUE)
+
+        encoder = find_element(AAC_ENCODERS) if has_audio else None
+        if has_audio and not encoder:
+            logging.warning('No AAC encoder is available, so renditions will have no audio')
+
+        if encoder:
+            description += ' {} name=audioin ! audioconvert ! audioresample ! {} bitrate={} ! aacparse ! tee name=audio'.format(
+                QUEUE, encoder, audio_bitrate * 1000)
+
+        for i, rendition in enumerate(self.renditions):
+            rendition['width'] = int(round(rendition['height'] * srcwidth / srcheight / 2)) * 2
+
+            description += ' video. ! {} ! videoscale ! video/x-raw,width={},height={},pixel-aspect-ratio=1/1 ! ' \
+                           'x264enc speed-preset={} threads={} bitrate={} ! video/x-h264,profile=high ! h264parse ! ' \
+                           '{} ! mp4mux name=mux{} faststart=true ! filesink location="{}"'.format(
+                QUEUE, rendition['width'], rendition['height'], speed_preset, threads, rendition['bitrate'],
+                QUEUE, i, rendition['path'])
+
+            if encoder:
+                description += ' audio. ! {} ! mux{}.'.format(QUEUE, i)
+
+        self.pipeline = Gst.parse_launch(description)
+
+        self.videoin = self.pipeline.get_by_name('videoin')
+        self.audioin = self.pipeline.get_by_name('audioin')
+
+        decodebin = self.pipeline.get_by_name('decodebin')
+        decodebin.connect('pad-added', self.pad_added)
+        if source_setup:
+            decodebin.connect('source-setup', source_setup)
+
+        self.watcher = PipelineWatcher(self.pipeline, 'transcoder', 'transcoder {}'.format(uri))
+
+    def pad_added(self, decodebin, pad):
+        caps = pad.get_current_caps()
+        name = caps.get_structure(0).get_name() if caps else ''
+
+        sink = None
+        if name.startswith('video/') and pad.get_stream_id() == (self.stream_id or pad.get_stream_id()):
+            sink = self.videoin.get_static_pad('sink')
+        elif name.startswith('audio/') and self.audioin:
+            sink = self.audioin.get_static_pad('sink')
+
+        if sink and not sink.is_linked():
+            pad.link(sink)
+            return
+
+        # Other streams still need somewhere to go, or they'd stop the pipeline as not-linked
+        fake = Gst.ElementFactory.make('fakesink')
+        self.pipeline.add(fake)
+        pad.link(fake.get_static_pad('sink'))
+        fake.sync_state_with_parent()
+
+    async def report_progress(self):
+        while True:
+            await asyncio.sleep(1)
+
+            res, position = self.pipeline.query_position(Gst.Format.TIME)
+            if res and self.duration:
+                self.on_progress(min(position / self.duration, 1))
+
+    async def transcode(self):
+        '''Returns the renditions written, or an empty list if transcoding failed'''
+        progress = asyncio.ensure_future(self.report_progress()) if self.on_progress else None
+
+        try:
+            done = await self.watcher.run()
+        finally:
+            if progress: progress.cancel()
+            self.watcher.stop()
+
+        return [{k: r[k] for k in ('name', 'path', 'width', 'height', 'bitrate') if k in r}
+                for r in self.renditions] if done else []
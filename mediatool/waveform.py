@@ -0,0 +1,62 @@
+import json
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .pcmtap import PCMTap, tap_branch
+
+PEAKS_BRANCH = tap_branch('peaks')
+
+class Waveform(PCMTap):
+    '''Reduces decoded audio to pairs of minimum and maximum sample values, peaks_per_second of them a second
+
+    Connect new_sample to the new-sample signal of the appsink in
+    PEAKS_BRANCH. The peaks are written in the JSON format used by
+    audiowaveform, which web players like peaks.js read directly. Requires
+    NumPy.'''
+    what = 'waveform peaks'
+
+    def __init__(self, peaks_per_second):
+        super().__init__()
+
+        self.peaks_per_second = peaks_per_second
+
+    @classmethod
+    def create(cls, peaks_per_second):
+        '''Returns a Waveform, or None if peaks are turned off or NumPy is unavailable'''
+        return super().create(peaks_per_second, peaks_per_second)
+
+    def empty(self):
+        return type(self)(self.peaks_per_second)
+
+    def set_rate(self, rate):
+        self.sample_rate = rate
+        self.block_size = max(1, rate // self.peaks_per_second)
+
+    def add_blocks(self, blocks):
+        self.chunks.append(np.stack((blocks.min(axis = 1), blocks.max(axis = 1)), axis = 1))
+
+    def finish(self):
+        '''Turns the samples left at the end of the stream into a last, shorter peak'''
+        if len(self.pending):
+            self.chunks.append(np.array([[self.pending.min(), self.pending.max()]], np.int16))
+            self.pending = np.zeros(0, np.int16)
+
+    def peaks(self):
+        return np.concatenate(self.chunks) if self.chunks else np.zeros((0, 2), np.int16)
+
+    def write(self, path):
+        peaks = self.peaks()
+
+        with open(path, 'w') as fd:
+            json.dump({
+                'version': 2,
+                'channels': 1,
+                'sample_rate': self.sample_rate,
+                'samples_per_pixel': self.block_size,
+                'bits': 16,
+                'length': len(peaks),
+                'data': peaks.flatten().tolist(),
+            }, fd, separators = (',', ':'))
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import stat
+import signal
+import socket
+import logging
+
+import asyncio
+
+from .analyze import Analyzer
+
+def remove_stale_socket(path):
+    '''Deletes a Unix socket left behind by a worker that's no longer listening on it'''
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            logging.info('Removing stale socket {}'.format(path))
+            os.unlink(path)
+        except OSError:
+            pass
+
+class Worker:
+    '''Runs a stream of analysis jobs concurrently on one event loop
+
+    Jobs are newline-delimited JSON objects with an _id and a uri. Every line
+    written back is tagged with the _id of the job it belongs to. Given a
+    scheduler in the options, jobs wait for it to admit them.'''
+    def __init__(self, concurrency = 4, **options):
+        self.concurrency = concurrency
+        self.options = options
+        
+        self.slots = asyncio.Semaphore(concurrency)
+        self.jobs = set()
+    
+    async def run_job(self, job, emit):
+        _id = job['_id']
+        scheduler = self.options.get('scheduler')
+        admitted = False
+        
+        try:
+            # Hold the job until there's room for it
+            degraded = await scheduler.admit() if scheduler else False
+            admitted = True
+            
+            analyzer = Analyzer(_id, job['uri'], emit = lambda msg: emit(dict(msg, _id = _id)), degraded = degraded,
+                                **self.options)
+            emit(dict(await analyzer.run(), _id = _id))
+        
+        except Exception as e:
+            logging.exception('Analysis of job {} failed'.format(_id))
+            emit({'_id': _id, 'error': str(e)})
+        
+        finally:
+            if scheduler and admitted: scheduler.release()
+            self.slots.release()
+    
+    async def submit(self, line, emit):
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict) or '_id' not in job or 'uri' not in job:
+                raise ValueError('Job needs an _id and a uri')
+        except ValueError:
+            logging.error('Ignoring invalid job: {}'.format(line))
+            emit({'error': 'Invalid job', 'job': line.decode(errors = 'replace')})
+            return
+        
+        # Stop reading jobs while every slot is busy
+        await self.slots.acquire()
+        
+        task = asyncio.ensure_future(self.run_job(job, emit))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+    
+    async def process(self, reader, emit):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            
+            if line.strip():
+                await self.submit(line, emit)
+        
+        await self.drain()
+    
+    async def drain(self):
+        '''Waits for every submitted job to finish'''
+        if self.jobs:
+            await asyncio.wait(list(self.jobs))
+    
+    async def serve_stdin(self):
+        loop = asyncio.get_event_loop()
+        
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        
+        def emit(msg):
+            print(json.dumps(msg), flush = True)
+        
+        await self.process(reader, emit)
+    
+    async def serve_socket(self, path):
+        async def handle(reader, writer):
+            def emit(msg):
+                writer.write((json.dumps(msg) + '\n').encode())
+            
+            try:
+                await self.process(reader, emit)
+                await writer.drain()
+            finally:
+                writer.close()
+        
+        # A socket that something is still listening on is left alone, so starting fails with EADDRINUSE
+        remove_stale_socket(path)
+        
+        server = await asyncio.start_unix_server(handle, path)
+        logging.info('Worker listening for jobs on {}'.format(path))
+        
+        # Only delete the socket on the way out if it's still ours
+        inode = os.stat(path).st_ino
+        
+        # Stop listening when asked to shut down, so the socket gets cleaned up
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, server.close)
+        
+        try:
+            await server.wait_closed()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            
+            server.close()
+            
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,46 @@
+import pytest
+
+from mediatool.audiomerge import (merge_replaygain, merge_bpm, bpm_confidence, tolerance_errors,
+                                  REPLAYGAIN_TOLERANCE, BPM_TOLERANCE)
+
+def test_replaygain_of_equal_segments_is_unchanged():
+    assert merge_replaygain([(-6.0, 60), (-6.0, 60), (-6.0, 30)]) == pytest.approx(-6.0)
+
+def test_replaygain_averages_power_by_duration():
+    # A loud minute, needing more attenuation, outweighs a quiet one, and more of it pulls the gain further down
+    assert -8 < merge_replaygain([(-10.0, 60), (-4.0, 60)]) < -7
+    assert merge_replaygain([(-10.0, 180), (-4.0, 60)]) < merge_replaygain([(-10.0, 60), (-4.0, 60)])
+
+def test_replaygain_ignores_missing_segments():
+    assert merge_replaygain([(None, 60), (-3.0, 60)]) == pytest.approx(-3.0)
+    assert merge_replaygain([(None, 60)]) == None
+
+def test_bpm_agreeing_segments_average():
+    assert merge_bpm([(120.0, 1), (121.0, 1), (122.0, 1)]) == 121.0
+
+def test_bpm_octave_errors_support_the_true_tempo():
+    # Segments locked onto half or double the tempo back up the segments that got it right
+    assert merge_bpm([(120.0, 1), (60.0, 1), (240.0, 1), (90.0, 1)]) == 120.0
+
+def test_bpm_vote_is_weighted_by_confidence():
+    # Two shaky estimates lose to one that settled early
+    assert merge_bpm([(100.0, 0.2), (100.0, 0.2), (128.0, 0.9)]) == 128.0
+    assert merge_bpm([(100.0, 0.2), (128.0, 0.2), (128.0, 0.1), (101.0, 0.1)]) == pytest.approx(100.3, abs = 0.1)
+
+def test_bpm_ignores_missing_and_unconfident_segments():
+    assert merge_bpm([(None, 1), (0, 1), (90.0, 0), (128.0, 0.5)]) == 128.0
+    assert merge_bpm([(None, 1)]) == None
+
+def test_bpm_confidence_counts_estimates_agreeing_with_the_last():
+    assert bpm_confidence([]) == 0
+    assert bpm_confidence([128.0, 128.5, 127.9]) == 1
+    assert bpm_confidence([90.0, 140.0, 128.0, 128.2]) == 0.5
+
+def test_tolerance_errors():
+    assert tolerance_errors((-7.0, 120.0), (-7.0 + REPLAYGAIN_TOLERANCE * 0.9, 120.0 * (1 + BPM_TOLERANCE * 0.9))) == []
+    assert tolerance_errors((None, None), (None, None)) == []
+
+    errors = tolerance_errors((-7.0, 120.0), (-7.0 - REPLAYGAIN_TOLERANCE * 1.5, 60.0))
+    assert len(errors) == 2 and 'ReplayGain' in errors[0] and 'BPM' in errors[1]
+
+    assert len(tolerance_errors((-7.0, None), (None, 120.0))) == 2
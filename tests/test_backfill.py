@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from mediatool.backfill import Backfill, read_manifest, read_journal
+
+def test_read_csv_manifest(tmp_path):
+    path = tmp_path / 'library.csv'
+    path.write_text('id,uri,title\n1,http://example.com/1.mp3,One\n2,http://example.com/2.mp4,Two\n')
+
+    assert list(read_manifest(str(path))) == [
+        {'_id': '1', 'uri': 'http://example.com/1.mp3'},
+        {'_id': '2', 'uri': 'http://example.com/2.mp4'},
+    ]
+
+def test_read_jsonl_manifest(tmp_path):
+    path = tmp_path / 'library.jsonl'
+    path.write_text('{"_id": "a", "uri": "file:///a.ogg"}\n\n{"_id": "b", "uri": "file:///b.ogg"}\n')
+
+    assert [job['_id'] for job in read_manifest(str(path))] == ['a', 'b']
+
+def test_manifest_entry_without_uri(tmp_path):
+    path = tmp_path / 'library.jsonl'
+    path.write_text('{"_id": "a"}\n')
+
+    with pytest.raises(ValueError):
+        list(read_manifest(str(path)))
+
+def test_read_journal_skips_cut_short_line(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    path.write_text('{"_id": "a", "status": "done"}\n'
+                    '{"_id": "b", "status": "error"}\n'
+                    '{"_id": "c", "stat')
+
+    assert read_journal(str(path)) == {'a'}
+    assert read_journal(str(tmp_path / 'missing.jsonl')) == set()
+
+def test_resume_skips_done_jobs(tmp_path):
+    manifest = tmp_path / 'library.jsonl'
+    manifest.write_text(''.join(json.dumps({'_id': i, 'uri': 'file:///{}.mp3'.format(i)}) + '\n' for i in 'abcd'))
+
+    # An interrupted run finished a and d, and c failed so it's tried again
+    journal = tmp_path / 'library.jsonl.journal.jsonl'
+    journal.write_text('{"_id": "a", "status": "done"}\n'
+                       '{"_id": "c", "status": "error"}\n'
+                       '{"_id": "d", "status": "done"}\n')
+
+    jobs, done = Backfill(str(manifest)).pending()
+
+    assert [job['_id'] for job in jobs] == ['b', 'c']
+    assert done == {'a', 'd'}
@@ -0,0 +1,69 @@
+import os
+
+from mediatool.cache import ResultCache, cache_key
+
+def make_file(tmp_path, name, size = 10):
+    path = tmp_path / name
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+def test_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    assert cache.get('nothing', str(tmp_path), 'job') == None
+
+def test_hit_copies_files_for_new_job(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    poster = make_file(tmp_path, 'first.poster.jpg')
+    webp = make_file(tmp_path, 'first.poster.webp')
+
+    result = {'type': 'video', 'poster': poster, 'thumb': '', 'variants': [{'path': webp, 'format': 'webp'}]}
+    cache.put('key', result, ['poster', 'thumb', 'variants'])
+
+    # The original files can go away without affecting the entry
+    os.unlink(poster)
+    os.unlink(webp)
+
+    dest = tmp_path / 'out'
+    dest.mkdir()
+    cached = cache.get('key', str(dest), 'second')
+
+    assert cached['type'] == 'video'
+    assert cached['poster'] == str(dest / 'second.poster.jpg')
+    assert cached['thumb'] == ''
+    assert cached['variants'] == [{'path': str(dest / 'second.poster.webp'), 'format': 'webp'}]
+    assert os.path.exists(cached['poster']) and os.path.exists(cached['variants'][0]['path'])
+
+def test_put_is_atomic_and_first_wins(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    cache.put('key', {'type': 'audio'}, [])
+    cache.put('key', {'type': 'video'}, [])
+
+    assert cache.get('key', str(tmp_path), 'job') == {'type': 'audio'}
+
+    # No temporary directories are left behind
+    assert os.listdir(str(tmp_path / 'cache')) == ['key']
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes = 10**9)
+
+    for i, key in enumerate(('old', 'used', 'new')):
+        cache.put(key, {'poster': make_file(tmp_path, '{}.poster.jpg'.format(key), 1000)}, ['poster'])
+        os.utime(cache.entry_path(key), (1000 + i, 1000 + i))
+
+    # Using an entry makes it the most recent
+    assert cache.get('old', str(tmp_path), 'job')
+
+    # Room for two entries
+    entry_size = sum(f.stat().st_size for f in os.scandir(cache.entry_path('new')))
+    cache.max_bytes = entry_size * 2
+    cache.evict()
+
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['new', 'old']
+
+def test_key_depends_on_options():
+    key = cache_key('abc', {'preview': True, 'image_formats': ['jpeg']})
+
+    assert key.startswith('abc-')
+    assert key == cache_key('abc', {'image_formats': ['jpeg'], 'preview': True})
+    assert key != cache_key('abc', {'preview': False, 'image_formats': ['jpeg']})
+    assert key != cache_key('abd', {'preview': True, 'image_formats': ['jpeg']})
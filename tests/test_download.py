@@ -0,0 +1,141 @@
+import re
+import asyncio
+import hashlib
+
+import pytest
+
+web = pytest.importorskip('aiohttp.web')
+
+from mediatool.download import Downloader, DownloadError
+
+DATA = bytes(range(256)) * 40
+
+def requested_range(request):
+    match = re.match(r'bytes=(\d+)-(\d+)', request.headers.get('Range', ''))
+    if match:
+        return int(match.group(1)), min(int(match.group(2)) + 1, len(DATA))
+
+def part(start, end, total = len(DATA)):
+    return web.Response(status = 206, body = DATA[start:end],
+                        headers = {'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, total)})
+
+class Server:
+    '''Serves DATA in several ways, recording the Range header of every request'''
+    def __init__(self):
+        self.requests = []
+        self.failures = {}
+
+        self.app = web.Application()
+        self.app.router.add_get('/{mode}', self.handle)
+
+    async def handle(self, request):
+        mode = request.match_info['mode']
+        r = requested_range(request)
+        self.requests.append((mode, r))
+
+        # Fail the first few requests with a server error
+        if self.failures.get(mode):
+            self.failures[mode] -= 1
+            return web.Response(status = 503)
+
+        if mode == 'missing':
+            return web.Response(status = 404)
+
+        if mode == 'norange' or not r:
+            return web.Response(body = DATA)
+
+        start, end = r
+
+        if mode == 'unknown':
+            return part(start, end, '*')
+
+        if mode == 'nototal':
+            return web.Response(status = 206, body = DATA[start:end])
+
+        if mode == 'short' and start and start % 1000 == 0:
+            # Every part after the first is cut short halfway through, to be resumed from there
+            end = start + (end - start) // 2
+
+        return part(start, end)
+
+    async def __aenter__(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def url(self, mode):
+        return 'http://127.0.0.1:{}/{}'.format(self.port, mode)
+
+def fetch(tmp_path, mode, failures = 0, **options):
+    '''Downloads from a fresh server, returning the file's contents, hash, reported sizes and progress, and requests'''
+    filename = str(tmp_path / 'download')
+    sizes, progress = [], []
+    hasher = hashlib.sha256()
+
+    async def run():
+        downloader = Downloader(retry_delay = 0, **dict({'part_size': 1000, 'connections': 3}, **options))
+
+        try:
+            async with Server() as server:
+                server.failures[mode] = failures
+                await downloader.fetch(server.url(mode), filename, sizes.append, progress.append, hasher)
+                return server.requests
+        finally:
+            await downloader.close()
+
+    requests = asyncio.run(run())
+
+    with open(filename, 'rb') as fd:
+        return fd.read(), hasher.digest(), sizes, progress, requests
+
+def check(data, digest, sizes, progress):
+    assert data == DATA
+    assert digest == hashlib.sha256(DATA).digest()
+    assert sizes == [len(DATA)]
+    assert progress == sorted(progress) and progress[-1] == len(DATA)
+
+def test_splits_into_ranges(tmp_path):
+    data, digest, sizes, progress, requests = fetch(tmp_path, 'ranges')
+    check(data, digest, sizes, progress)
+
+    assert sorted(r for mode, r in requests) == [(start, min(start + 1000, len(DATA)))
+                                                 for start in range(0, len(DATA), 1000)]
+
+def test_resumes_parts_cut_short(tmp_path):
+    data, digest, sizes, progress, requests = fetch(tmp_path, 'short')
+    check(data, digest, sizes, progress)
+
+    # The second half of each part is asked for again on its own
+    assert ('short', (1500, 2000)) in requests
+
+def test_streams_when_ranges_unsupported(tmp_path):
+    data, digest, sizes, progress, requests = fetch(tmp_path, 'norange')
+    check(data, digest, sizes, progress)
+    assert len(requests) == 1
+
+@pytest.mark.parametrize('mode', ['unknown', 'nototal'])
+def test_streams_when_total_size_unknown(tmp_path, mode):
+    data, digest, sizes, progress, requests = fetch(tmp_path, mode)
+    check(data, digest, sizes, progress)
+
+    # The partial response is dropped and the whole file asked for
+    assert requests == [(mode, (0, 1000)), (mode, None)]
+
+def test_retries_first_request_after_server_errors(tmp_path):
+    data, digest, sizes, progress, requests = fetch(tmp_path, 'ranges', failures = 2)
+    check(data, digest, sizes, progress)
+
+def test_gives_up_after_retries(tmp_path):
+    with pytest.raises(Exception):
+        fetch(tmp_path, 'ranges', failures = 3, retries = 2)
+
+def test_client_errors_are_not_retried(tmp_path):
+    with pytest.raises(Exception):
+        fetch(tmp_path, 'missing')
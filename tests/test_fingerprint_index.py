@@ -0,0 +1,52 @@
+from mediatool.fingerprint_index import FingerprintIndex
+
+A = 'f0f0f0f0f0f0f0f0'
+A_NEAR = 'f0f0f0f0f0f0f0f3'
+B = '0123456789abcdef'
+
+def test_nearest_finds_close_hash():
+    index = FingerprintIndex()
+    index.add('a', {'video': [A]})
+    index.add('b', {'video': [B]})
+
+    assert index.nearest({'video': [A_NEAR]}) == ('a', 2)
+
+def test_nearest_ignores_distant_and_excluded():
+    index = FingerprintIndex(max_distance = 4)
+    index.add('b', {'video': [B]})
+
+    assert index.nearest({'video': [A]}) == None
+
+    index.add('a', {'video': A})
+    assert index.nearest({'video': A}, exclude = 'a') == None
+
+def test_nearest_compares_only_shared_kinds():
+    index = FingerprintIndex()
+    index.add('a', {'audio': A})
+
+    assert index.nearest({'video': [A]}) == None
+    assert index.nearest({'audio': A, 'video': [B]}) == ('a', 0)
+
+def test_reinsert_replaces_old_hashes():
+    index = FingerprintIndex()
+    index.add('a', {'video': [A, A]})
+    index.add('a', {'video': [B]})
+
+    assert index.nearest({'video': [A]}) == None
+    assert index.nearest({'video': [B]}) == ('a', 0)
+
+    # Only the new hash's four chunks are left in the tables
+    assert sum(len(table) for table in index.tables.values()) == 4
+
+def test_saved_index_reloads(tmp_path):
+    path = str(tmp_path / 'index.jsonl')
+
+    index = FingerprintIndex(path)
+    index.add('a', {'video': [A]})
+    index.add('a', {'video': [B]})
+    index.add('c', None)
+
+    reloaded = FingerprintIndex(path)
+    assert set(reloaded.items) == {'a'}
+    assert reloaded.nearest({'video': [B]}) == ('a', 0)
+    assert reloaded.nearest({'video': [A]}) == None
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from mediatool.scheduler import Scheduler, StageTimeout, NANOSECONDS
+
+def test_deadline_scales_with_duration():
+    scheduler = Scheduler()
+    assert scheduler.deadline('audio', 600 * NANOSECONDS) == 60 + 0.5 * 600
+
+def test_deadline_needs_duration_when_it_scales_with_it():
+    assert Scheduler().deadline('audio', None) == None
+    assert Scheduler().deadline('transcode', None) == None
+
+def test_deadline_before_duration_is_known_scales_with_size():
+    scheduler = Scheduler()
+
+    # These stages are what find the duration, so it never comes into it
+    assert scheduler.deadline('single_pass', None, 500 * 2**20) == 60 + 500
+    assert scheduler.deadline('single_pass', None, None) == None
+    assert scheduler.deadline('probe', None, 100 * 2**20) == pytest.approx(35)
+
+def test_deadline_fixed_and_unlisted():
+    scheduler = Scheduler(deadline_scale = 2)
+    assert scheduler.deadline('poster_grab', None) == 120
+    assert scheduler.deadline('download', None) == None
+    assert Scheduler(deadline_scale = 0).deadline('poster_grab', None) == None
+
+def test_run_stage_without_deadline():
+    async def stage():
+        await asyncio.sleep(0.01)
+        return 'done'
+
+    assert asyncio.run(Scheduler().run_stage('single_pass', None, stage())) == 'done'
+
+def test_run_stage_times_out():
+    scheduler = Scheduler(deadline_scale = 0.001)
+    cancelled = []
+
+    async def stage():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    with pytest.raises(StageTimeout):
+        asyncio.run(scheduler.run_stage('poster_grab', None, stage()))
+
+    assert cancelled
+
+def test_run_stage_excludes_time_waiting_on_download():
+    # A 0.06s deadline for a stage that takes 0.1s, 0.08s of it waiting on the download
+    scheduler = Scheduler(deadline_scale = 0.001)
+    clock = {}
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        clock['start'] = loop.time()
+
+        def waited():
+            return min(loop.time() - clock['start'], 0.08)
+
+        async def stage():
+            await asyncio.sleep(0.1)
+            return 'done'
+
+        return await scheduler.run_stage('poster_grab', None, stage(), waited = waited)
+
+    assert asyncio.run(main()) == 'done'
+
+def test_run_stage_passes_on_errors():
+    async def stage():
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError):
+        asyncio.run(Scheduler().run_stage('poster_grab', None, stage()))